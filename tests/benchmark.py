@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""Benchmarks for networkd-dispatcher
+
+Drives Dispatcher._receive_signal() with synthetic PropertiesChanged
+signals, with networkctl stubbed out using the outputs in tests/inputs and
+scripts recorded instead of executed, and writes the results as JSON.
+
+    python3 tests/benchmark.py [-o results.json] [--interfaces 1,100,1000]
+                               [--scripts 0,1,10] [--events 1000]
+
+Each result reports the latency from a signal to the execution of its first
+script (or to the end of its handling if no scripts are run), the number of
+signals handled per second, and the number of processes which would have
+been forked.
+
+The memory results compare the interface registry holding --links links with
+the dictionaries of namedtuples it replaced, along with the time taken by a
+rescan which finds no new links.
+
+The spawn results compare the latency from starting a script to its exit
+when it is started directly with subprocess.Popen and when it is started by
+the spawn helper, with --ballast MiB allocated to stand in for the memory of
+a running dispatcher.
+
+The env results compare building the environment of a script by copying
+the environment of the dispatcher for each event with layering the variables
+of the event over the base environment built once, with --env-vars variables
+in the environment: the CPU time and the memory held per event, and the CPU
+time per event including the envp list built when the script is started.
+
+The startup results report the time taken to import the dispatcher, and the
+time from calling main() until readiness is notified and until the initial
+interface scan has completed, with and without --early-ready, where each
+networkctl call takes --networkctl-delay milliseconds.
+"""
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+import networkd_dispatcher  # noqa: E402
+from networkd_dispatcher import Dispatcher  # noqa: E402
+
+INPUTS = os.path.join(myPath, 'inputs')
+STATES = ('routable', 'degraded')
+
+
+def read_input(name):
+    with open(os.path.join(INPUTS, name), 'rb') as fh:
+        return fh.read()
+
+
+def percentile(values, pct):
+    """Return the pct percentile of values, by the nearest-rank method"""
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank - 1, 0)]
+
+
+class FakeSystem():
+    """Stands in for networkctl and for the scripts run by the dispatcher,
+    counting the processes which would have been forked"""
+
+    def __init__(self, n_ifaces, delay=0):
+        # Same layout as tests/inputs/networkctl_list
+        self.list_out = ''.join(
+            '%3d %-16s %-18s %-11s %s\n' % (idx, 'eth%d' % idx, 'ether',
+                                            STATES[0], 'configured')
+            for idx in range(1, n_ifaces + 1)).encode('utf-8')
+        self.status_out = read_input('networkctl_status').replace(
+            b'Type: wlan', b'Type: ether')
+        self.forks = {'networkctl': 0, 'scripts': 0}
+        self.first_exec = None
+        self.delay = delay
+
+    def check_output(self, cmd, **kwargs):
+        self.forks['networkctl'] += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if cmd[1] == 'list':
+            return self.list_out
+        return self.status_out
+
+    def popen(self, script, env=None, **kwargs):
+        if self.first_exec is None:
+            self.first_exec = time.perf_counter()
+        self.forks['scripts'] += 1
+        proc = mock.MagicMock()
+        proc.pid = 0
+        proc.wait.return_value = 0
+        return proc
+
+
+def make_scripts(base, n_scripts):
+    """Create a script directory with n_scripts scripts for each state"""
+    for state in STATES:
+        subdir = os.path.join(base, state + '.d')
+        os.mkdir(subdir)
+        for i in range(n_scripts):
+            path = os.path.join(subdir, '%02d-script' % i)
+            with open(path, 'w') as fh:
+                fh.write('#!/bin/sh\n')
+            os.chmod(path, 0o755)
+
+
+def bench_dispatch(n_ifaces, n_scripts, n_events, **dispatcher_args):
+    """Send n_events signals spread over n_ifaces interfaces, each changing
+    the operational state, to a dispatcher with n_scripts scripts per
+    state"""
+    system = FakeSystem(n_ifaces)
+    with tempfile.TemporaryDirectory() as script_dir, \
+            mock.patch.object(subprocess, 'check_output',
+                              system.check_output), \
+            mock.patch.object(subprocess, 'Popen', system.popen), \
+            mock.patch.object(networkd_dispatcher, 'NETWORKCTL',
+                              '/usr/bin/networkctl'), \
+            mock.patch.object(networkd_dispatcher, 'check_script',
+                              lambda p: os.access(p, os.X_OK)):
+        make_scripts(script_dir, n_scripts)
+        dispatcher = Dispatcher(script_dir=script_dir, **dispatcher_args)
+        signals = [
+            ('org.freedesktop.network1.Link',
+             {'OperationalState': STATES[(i // n_ifaces + 1) % 2]},
+             None, networkd_dispatcher.dbus_link_path(i % n_ifaces + 1))
+            for i in range(n_events)]
+        system.forks = dict.fromkeys(system.forks, 0)
+
+        latencies = []
+        start = time.perf_counter()
+        for signal in signals:
+            system.first_exec = None
+            sent = time.perf_counter()
+            dispatcher._receive_signal(*signal)
+            done = system.first_exec or time.perf_counter()
+            latencies.append(done - sent)
+        elapsed = time.perf_counter() - start
+
+    return {
+        'interfaces': n_ifaces,
+        'scripts': n_scripts,
+        'events': n_events,
+        'events_per_second': n_events / elapsed,
+        'latency_p50_us': percentile(latencies, 50) * 1e6,
+        'latency_p99_us': percentile(latencies, 99) * 1e6,
+        'forks': system.forks,
+    }
+
+
+def traced_size(build):
+    """Return the result of build() and the memory it allocated"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        return result, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+def bench_memory(n_links):
+    """Measure the memory held for n_links interfaces, as read from
+    networkctl by a scan, and the time taken to rescan them"""
+    system = FakeSystem(n_links)
+
+    def namedtuple_dicts():
+        names_by_idx, ifaces_by_name = {}, {}
+        for link in networkd_dispatcher.get_networkctl_list():
+            names_by_idx[link.idx] = link.name
+            ifaces_by_name[link.name] = link
+        return names_by_idx, ifaces_by_name
+
+    def registry():
+        return networkd_dispatcher.InterfaceRegistry(
+            networkd_dispatcher.get_networkctl_list())
+
+    with mock.patch.object(subprocess, 'check_output', system.check_output), \
+            mock.patch.object(networkd_dispatcher, 'NETWORKCTL',
+                              '/usr/bin/networkctl'):
+        _, old_size = traced_size(namedtuple_dicts)
+        interfaces, size = traced_size(registry)
+        links = networkd_dispatcher.get_networkctl_list()
+    start = time.perf_counter()
+    interfaces.update(links)
+    rescan = time.perf_counter() - start
+    return {
+        'links': n_links,
+        'namedtuple_dicts_bytes': old_size,
+        'registry_bytes': size,
+        'rescan_unchanged_us': rescan * 1e6,
+    }
+
+
+def bench_spawn(n_spawns, ballast_mb):
+    """Start /bin/true n_spawns times directly and with the spawn helper,
+    waiting for each to exit, from a process holding ballast_mb MiB"""
+    ballast = bytearray(ballast_mb << 20)
+    # Touch every page, so that a fork has to copy the page tables
+    for offset in range(0, len(ballast), 4096):
+        ballast[offset] = 1
+    helper = networkd_dispatcher.SpawnHelper()
+    env = {'PATH': '/usr/bin:/bin'}
+    starters = (('popen', lambda: subprocess.Popen('/bin/true', env=env)),
+                ('helper', lambda: helper.spawn('/bin/true', env)))
+    results = {'spawns': n_spawns, 'ballast_mb': ballast_mb}
+    try:
+        for name, start in starters:
+            latencies = []
+            for _ in range(n_spawns):
+                started = time.perf_counter()
+                start().wait()
+                latencies.append(time.perf_counter() - started)
+            results[name + '_p50_us'] = percentile(latencies, 50) * 1e6
+            results[name + '_p99_us'] = percentile(latencies, 99) * 1e6
+    finally:
+        helper.sock.close()
+        helper.proc.wait()
+    del ballast
+    return results
+
+
+def copied_env(iface, data, state):
+    """Build the environment of a script as was done before the base
+    environment was built once, copying the environment twice"""
+    env = dict(os.environ)
+    env.update(networkd_dispatcher.build_script_env(iface, data))
+    env = dict(env)
+    env['STATE'] = state
+    return env
+
+
+def envp(env):
+    """Build the envp list from env, as subprocess does to start a script"""
+    return [os.fsencode(name) + b'=' + os.fsencode(value)
+            for name, value in env.items()]
+
+
+def bench_env(n_events, n_vars):
+    """Build the environment of a script n_events times, by copying the
+    environment holding n_vars variables and by layering the variables of
+    the event over the base environment"""
+    padding = {'BENCH_VAR_%d' % i: 'x' * 32
+               for i in range(max(n_vars - len(os.environ), 0))}
+    iface = networkd_dispatcher.Interface(2, 'eth0', 'ether', 'routable',
+                                          'configured')
+    data = {'Type': 'ether', 'OperationalState': 'routable',
+            'AdministrativeState': 'configured', 'InterfaceName': 'eth0',
+            'Address': ['192.168.1.2', 'fe80::1']}
+    results = {'events': n_events, 'env_vars': n_vars}
+    with mock.patch.dict(os.environ, padding):
+        dispatcher = Dispatcher(script_cache=False, scan=False)
+
+        def overlay_env(iface, data, state):
+            overlay = networkd_dispatcher.build_script_env(iface, data)
+            overlay['STATE'] = state
+            return dispatcher.overlay_env(overlay)
+        for name, build in (('copied', copied_env), ('overlay', overlay_env)):
+            start = time.process_time()
+            for _ in range(n_events):
+                build(iface, data, 'routable')
+            results[name + '_cpu_us'] = ((time.process_time() - start) /
+                                         n_events * 1e6)
+            start = time.process_time()
+            for _ in range(n_events):
+                envp(build(iface, data, 'routable'))
+            results[name + '_spawn_cpu_us'] = ((time.process_time() - start) /
+                                               n_events * 1e6)
+            # Memory held by the environments of queued scripts
+            _, size = traced_size(lambda: [build(iface, data, 'routable')
+                                           for _ in range(100)])
+            results[name + '_bytes'] = size / 100
+    return results
+
+
+def bench_import(runs=5):
+    """Return the median time taken to import the dispatcher, in a new
+    interpreter each time"""
+    code = ('import sys, time; sys.path.insert(0, %r); '
+            'start = time.perf_counter(); import networkd_dispatcher; '
+            'print(time.perf_counter() - start)' % os.path.join(myPath, '..'))
+    return percentile([float(subprocess.check_output([sys.executable, '-c',
+                                                      code]))
+                       for _ in range(runs)], 50)
+
+
+def bench_startup(n_ifaces, early_ready, delay_ms):
+    """Run main() until it would enter the main loop, then run what it left
+    for the main loop, recording when readiness was notified and when the
+    initial scan completed"""
+    system = FakeSystem(n_ifaces, delay_ms / 1000.0)
+    times = {}
+    idle = []
+    start_dispatcher = Dispatcher.start
+
+    def start(self, *args):
+        result = start_dispatcher(self, *args)
+        times['scanned'] = time.perf_counter()
+        return result
+
+    def sd_notify(**kwargs):
+        times['ready'] = time.perf_counter()
+
+    class MainLoop():
+        def run(self):
+            for function, args in idle:
+                function(*args)
+
+    with tempfile.TemporaryDirectory() as script_dir:
+        make_scripts(script_dir, 1)
+        argv = ['networkd-dispatcher', '-qq', '-S', script_dir,
+                '--state-file', '']
+        if early_ready:
+            argv.append('--early-ready')
+        glib = networkd_dispatcher.glib
+        with mock.patch.object(sys, 'argv', argv), \
+                mock.patch.object(subprocess, 'check_output',
+                                  system.check_output), \
+                mock.patch.object(networkd_dispatcher, 'NETWORKCTL',
+                                  '/usr/bin/networkctl'), \
+                mock.patch.object(networkd_dispatcher, 'sd_notify',
+                                  sd_notify), \
+                mock.patch.object(networkd_dispatcher.dbus.mainloop.glib,
+                                  'DBusGMainLoop'), \
+                mock.patch.object(Dispatcher, 'register'), \
+                mock.patch.object(Dispatcher, 'start', start), \
+                mock.patch.object(glib, 'MainLoop', MainLoop), \
+                mock.patch.object(glib, 'idle_add',
+                                  lambda function, *args:
+                                  idle.append((function, args))):
+            started = time.perf_counter()
+            networkd_dispatcher.main()
+    return {
+        'interfaces': n_ifaces,
+        'early_ready': early_ready,
+        'networkctl_delay_ms': delay_ms,
+        'ready_ms': (times['ready'] - started) * 1e3,
+        'scanned_ms': (times['scanned'] - started) * 1e3,
+    }
+
+
+def parse_counts(value):
+    return [int(x) for x in value.split(',')]
+
+
+def parse_args(args):
+    ap = argparse.ArgumentParser(description='networkd-dispatcher benchmarks')
+    ap.add_argument('-o', '--output', action='store',
+                    help='Write results to this file instead of stdout')
+    ap.add_argument('--interfaces', action='store', type=parse_counts,
+                    default=[1, 100, 1000],
+                    help='Comma-separated numbers of interfaces')
+    ap.add_argument('--scripts', action='store', type=parse_counts,
+                    default=[0, 1, 10],
+                    help='Comma-separated numbers of scripts per state')
+    ap.add_argument('--events', action='store', type=int, default=1000,
+                    help='Number of signals to send per run')
+    ap.add_argument('--links', action='store', type=int, default=10000,
+                    help='Number of links for the memory benchmark')
+    ap.add_argument('--spawns', action='store', type=int, default=200,
+                    help='Number of scripts to start per spawn benchmark')
+    ap.add_argument('--ballast', action='store', type=parse_counts,
+                    default=[0, 256],
+                    help='Comma-separated MiB of memory to hold while '
+                    'starting scripts')
+    ap.add_argument('--env-vars', action='store', type=int, default=50,
+                    help='Number of variables in the environment of the '
+                    'dispatcher for the env benchmark')
+    ap.add_argument('--networkctl-delay', action='store', type=float,
+                    default=20,
+                    help='Milliseconds taken by each networkctl call in the '
+                    'startup benchmark')
+    return ap.parse_args(args)
+
+
+def main(args):
+    args = parse_args(args)
+    results = {
+        'python': sys.version.split()[0],
+        'dispatch': [bench_dispatch(n_ifaces, n_scripts, args.events)
+                     for n_ifaces in args.interfaces
+                     for n_scripts in args.scripts],
+        'memory': bench_memory(args.links),
+        'spawn': [bench_spawn(args.spawns, ballast_mb)
+                  for ballast_mb in args.ballast],
+        'env': bench_env(args.events, args.env_vars),
+        'startup': {
+            'import_ms': bench_import() * 1e3,
+            'main': [bench_startup(n_ifaces, early_ready,
+                                   args.networkctl_delay)
+                     for n_ifaces in args.interfaces
+                     for early_ready in (False, True)],
+        },
+    }
+    out = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(out + '\n')
+    else:
+        print(out)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
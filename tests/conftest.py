@@ -235,3 +235,23 @@ def Dispatcher_ifaces_by_name():
 @pytest.fixture()
 def Dispatcher_iface_names_by_idx():
     return {1: 'lo', 2: 'wlan0', 3: 'eth0'}
+
+
+@pytest.fixture()
+def get_dbus_link_status_out():
+    """ Returns expected output from
+    networkd-dispatcher.get_dbus_link_status for the link_describe input """
+    return {'Link File': ['/etc/systemd/network/10-wifi.link'],
+            'Network File': ['/etc/systemd/network/20-wifi.network'],
+            'Type': 'wlan',
+            'State': ['routable (configured)'],
+            'OperationalState': 'routable',
+            'AdministrativeState': 'configured',
+            'Path': ['pci-0000:3a:00.0'],
+            'Driver': ['iwlwifi'],
+            'Vendor': ['Intel Corporation'],
+            'Model': ['Wireless 8265 / 8275 (Dual Band Wireless-AC 8265)'],
+            'HW Address': ['dd:ee:aa:dd:12:34'],
+            'Address': ['1.1.1.100', 'fe80::b2c0:90ff:fe60:861d'],
+            'Gateway': ['1.1.1.1'],
+            'DNS': ['10.10.10.1']}
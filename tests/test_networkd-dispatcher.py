@@ -1,19 +1,26 @@
 import collections
 from collections import namedtuple
+import ctypes
 import dbus
 import errno
+import json
 import logging
 import mock
 import os
+import queue
+import select
 import socket
+import struct
 import subprocess
 import sys
+import time
 import pytest
 from mock import patch
 myPath = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, myPath + '/../')
 import networkd_dispatcher
-from networkd_dispatcher import (Dispatcher, NetworkctlListState, LOG_FORMAT)
+from networkd_dispatcher import (Dispatcher, InterfaceRegistry,
+                                 NetworkctlListState, LOG_FORMAT)
 
 try:
     from gi.repository import GLib as glib
@@ -44,6 +51,21 @@ def test_resolve_path(monkeypatch):
     assert networkd_dispatcher.resolve_path('vpn') is None
 
 
+def test_tool_path(monkeypatch):
+    monkeypatch.setattr(networkd_dispatcher, 'IW',
+                        networkd_dispatcher.UNRESOLVED)
+    resolved = []
+    monkeypatch.setattr(networkd_dispatcher, 'resolve_path',
+                        lambda name: resolved.append(name) or '/sbin/iw')
+    assert networkd_dispatcher.tool_path('iw') == '/sbin/iw'
+    assert networkd_dispatcher.tool_path('iw') == '/sbin/iw'
+    assert resolved == ['iw']
+    # missing commands are looked up once too
+    monkeypatch.setattr(networkd_dispatcher, 'IW', None)
+    assert networkd_dispatcher.tool_path('iw') is None
+    assert resolved == ['iw']
+
+
 @patch('subprocess.check_output')
 def test_get_networkctl_status(mock_subprocess, monkeypatch,
                                get_networkctl_status_out, caplog):
@@ -71,9 +93,372 @@ def test_get_networkctl_status(mock_subprocess, monkeypatch,
             get_networkctl_status_out)
 
 
+@patch('subprocess.check_output')
+def test_get_networkctl_statuses(mock_subprocess, monkeypatch,
+                                 get_networkctl_status_out, caplog):
+    monkeypatch.setattr(networkd_dispatcher, 'NETWORKCTL',
+                        '/usr/bin/networkctl')
+    out = get_datafile('networkctl_status')
+    mock_subprocess.return_value = (out + b'\n' +
+                                    out.replace(b'2: wlan0', b'3: eth0'))
+    statuses = networkd_dispatcher.get_networkctl_statuses(['wlan0', 'eth0'])
+    assert statuses == {'wlan0': get_networkctl_status_out,
+                        'eth0': get_networkctl_status_out}
+    mock_subprocess.assert_called_with(['/usr/bin/networkctl', 'status',
+                                        '--no-pager', '--no-legend', '--',
+                                        'wlan0', 'eth0'])
+    # CalledProcessError
+    caplog.clear()
+    mock_subprocess.side_effect = (
+        subprocess.CalledProcessError(1, '/usr/bin/networkctl'))
+    assert networkd_dispatcher.get_networkctl_statuses(['wlan0', 'x']) is None
+    _, _, err = caplog.record_tuples[0]
+    assert err.startswith('Failed to get interfaces wlan0 x status: ')
+
+
+def test_dbus_link_path():
+    assert (networkd_dispatcher.dbus_link_path(3) ==
+            '/org/freedesktop/network1/link/_33')
+    assert (networkd_dispatcher.dbus_link_path(12) ==
+            '/org/freedesktop/network1/link/_312')
+
+
+def test_format_dbus_address():
+    assert (networkd_dispatcher.format_dbus_address(socket.AF_INET,
+                                                    [10, 0, 0, 1]) ==
+            '10.0.0.1')
+    assert (networkd_dispatcher.format_dbus_address(socket.AF_INET6,
+                                                    [0] * 15 + [1]) == '::1')
+    # already formatted by networkd
+    assert (networkd_dispatcher.format_dbus_address(socket.AF_INET,
+                                                    '10.0.0.1') == '10.0.0.1')
+
+
+def test_get_dbus_link_status(get_dbus_link_status_out, caplog):
+    bus = mock.MagicMock()
+    link = bus.get_object.return_value
+    link.Describe.return_value = get_datafile('link_describe').decode()
+    assert (networkd_dispatcher.get_dbus_link_status(bus, 2) ==
+            get_dbus_link_status_out)
+    bus.get_object.assert_called_with('org.freedesktop.network1',
+                                      '/org/freedesktop/network1/link/_32')
+    # D-Bus error, e.g. Describe() not supported by networkd
+    caplog.clear()
+    link.Describe.side_effect = dbus.exceptions.DBusException('no method')
+    assert networkd_dispatcher.get_dbus_link_status(bus, 2) is None
+    _, _, err = caplog.record_tuples[0]
+    assert err == 'Failed to get interface 2 status over D-Bus: no method'
+
+
+def test_get_dbus_link_list(get_networkctl_list_out, caplog):
+    bus = mock.MagicMock()
+    manager = bus.get_object.return_value
+    # all links described at once
+    manager.Describe.return_value = json.dumps({'Interfaces': [
+        {'Index': i.idx, 'Name': i.name, 'Type': i.type,
+         'OperationalState': i.operational,
+         'AdministrativeState': i.administrative}
+        for i in reversed(get_networkctl_list_out)]})
+    with patch.object(networkd_dispatcher, 'get_dbus_link_status',
+                      mock.Mock(side_effect=AssertionError)):
+        assert (networkd_dispatcher.get_dbus_link_list(bus) ==
+                get_networkctl_list_out)
+    manager.ListLinks.assert_not_called()
+    # or one by one where the manager cannot describe them
+    caplog.set_level(logging.DEBUG)
+    manager.Describe.side_effect = dbus.exceptions.DBusException('no method')
+    manager.ListLinks.return_value = [
+        (i.idx, i.name, networkd_dispatcher.dbus_link_path(i.idx))
+        for i in get_networkctl_list_out]
+    status = {i.idx: {'Type': i.type, 'OperationalState': i.operational,
+                      'AdministrativeState': i.administrative}
+              for i in get_networkctl_list_out}
+    with patch.object(networkd_dispatcher, 'get_dbus_link_status',
+                      lambda bus, idx: status[idx]):
+        assert (networkd_dispatcher.get_dbus_link_list(bus) ==
+                get_networkctl_list_out)
+    _, _, debug = caplog.record_tuples[0]
+    assert debug == ('Describing all links over D-Bus failed, listing them '
+                     'instead: no method')
+    # status of a link unavailable
+    with patch.object(networkd_dispatcher, 'get_dbus_link_status',
+                      lambda bus, idx: None):
+        assert networkd_dispatcher.get_dbus_link_list(bus) is None
+    # D-Bus error
+    caplog.clear()
+    manager.ListLinks.side_effect = dbus.exceptions.DBusException('no bus')
+    assert networkd_dispatcher.get_dbus_link_list(bus) is None
+    _, _, err = caplog.record_tuples[-1]
+    assert err == 'networkd link list over D-Bus failed: no bus'
+
+
+def test_parse_netlink_links():
+    names = networkd_dispatcher.parse_netlink_links(
+        get_datafile('netlink_getlink'))
+    assert names == {1: 'lo', 2: 'ifb0', 3: 'ifb1', 4: 'eth0'}
+    # other messages are skipped
+    assert networkd_dispatcher.parse_netlink_links(
+        get_datafile('netlink_getaddr')) == {}
+
+
+def test_parse_netlink_addrs():
+    addrs = networkd_dispatcher.parse_netlink_addrs(
+        get_datafile('netlink_getaddr'))
+    assert addrs == {1: ['127.0.0.1', '::1'],
+                     4: ['192.0.2.2', 'fd00::2', 'fe80::fc:ff:fe00:1']}
+    assert networkd_dispatcher.parse_netlink_addrs(
+        get_datafile('netlink_getlink')) == {}
+
+
+def test_parse_netlink_messages():
+    hdr = networkd_dispatcher.NLMSG_HDR
+    # error reply
+    buf = hdr.pack(hdr.size + 4, networkd_dispatcher.NLMSG_ERROR, 0, 1,
+                   0) + struct.pack('=i', -errno.EPERM)
+    with pytest.raises(OSError) as e:
+        networkd_dispatcher.parse_netlink_messages(buf)
+    assert e.value.errno == errno.EPERM
+    # truncated message
+    with pytest.raises(ValueError):
+        networkd_dispatcher.parse_netlink_messages(hdr.pack(4, 16, 0, 1, 0))
+    # truncated attribute
+    assert networkd_dispatcher.parse_rtattrs(b'\x02\x00\x03\x00', 0) == {}
+
+
+def test_nlmsg_final():
+    hdr = networkd_dispatcher.NLMSG_HDR
+    assert not networkd_dispatcher.nlmsg_final(b'')
+    assert not networkd_dispatcher.nlmsg_final(
+        hdr.pack(hdr.size, networkd_dispatcher.RTM_NEWLINK, 0, 1, 0))
+    assert networkd_dispatcher.nlmsg_final(
+        hdr.pack(hdr.size, networkd_dispatcher.RTM_NEWLINK, 0, 1, 0) +
+        hdr.pack(hdr.size + 4, networkd_dispatcher.NLMSG_DONE, 0, 1, 0) +
+        b'\0' * 4)
+    assert networkd_dispatcher.nlmsg_final(hdr.pack(0, 0, 0, 0, 0))
+
+
+@patch('socket.socket')
+def test_netlink_dump(mock_socket):
+    capture = get_datafile('netlink_getaddr')
+    sock = mock_socket.return_value
+    # reply split over several reads
+    sock.recv.side_effect = [capture[:164], capture[164:]]
+    assert networkd_dispatcher.netlink_dump(22, b'\0' * 8) == capture
+    mock_socket.assert_called_with(socket.AF_NETLINK, socket.SOCK_RAW, 0)
+    sock.send.assert_called_with(b'\x18\x00\x00\x00\x16\x00\x01\x03'
+                                 b'\x01\x00\x00\x00\x00\x00\x00\x00' +
+                                 b'\0' * 8)
+    sock.close.assert_called_with()
+    # socket closed by the kernel
+    sock.recv.side_effect = [b'']
+    assert networkd_dispatcher.netlink_dump(22, b'\0' * 8) == b''
+
+
+def test_get_netlink_links(monkeypatch, caplog):
+    captures = {networkd_dispatcher.RTM_GETLINK: 'netlink_getlink',
+                networkd_dispatcher.RTM_GETADDR: 'netlink_getaddr'}
+    monkeypatch.setattr(networkd_dispatcher, 'netlink_dump',
+                        lambda t, r: get_datafile(captures[t]))
+    links = networkd_dispatcher.get_netlink_links()
+    assert sorted(links) == ['eth0', 'ifb0', 'ifb1', 'lo']
+    assert links['eth0'] == networkd_dispatcher.NetlinkLink(
+        4, 'eth0', ['192.0.2.2', 'fd00::2', 'fe80::fc:ff:fe00:1'])
+    assert links['ifb0'].addresses == []
+
+    def fail(msg_type, request):
+        raise OSError(errno.EPERM, 'Operation not permitted')
+    monkeypatch.setattr(networkd_dispatcher, 'netlink_dump', fail)
+    caplog.clear()
+    assert networkd_dispatcher.get_netlink_links() is None
+    _, _, err = caplog.record_tuples[0]
+    assert err == 'rtnetlink dump failed: [Errno 1] Operation not permitted'
+
+
 def test_unquote():
     str = '\\ssid\\awesome'
     assert networkd_dispatcher.unquote(str) == 'ssidawesome'
+    assert networkd_dispatcher.unquote('a\\\\b\\') == 'a\\b'
+
+
+def nla(attr_type, value):
+    length = 4 + len(value)
+    return struct.pack('=HH', length, attr_type) + value + b'\0' * (
+        -length % 4)
+
+
+def genl_msg(msg_type, cmd, attrs, seq=0):
+    payload = struct.pack('=BBH', cmd, 1, 0) + attrs
+    return struct.pack('=IHHII', 16 + len(payload), msg_type, 0, seq,
+                       0) + payload
+
+
+NL80211_ID = 28
+# CTRL_CMD_NEWFAMILY reply, with the groups nested as the kernel does
+GENL_FAMILY_REPLY = genl_msg(0x10, 1, (
+    nla(1, struct.pack('=H', NL80211_ID)) + nla(2, b'nl80211\0') +
+    nla(0x8007, nla(1, nla(1, b'config\0') + nla(2, struct.pack('=I', 5))) +
+        nla(2, nla(1, b'mlme\0') + nla(2, struct.pack('=I', 7))))), 1)
+
+
+class FakeGenlSocket():
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.sent = []
+        self.groups = []
+        self.blocking = True
+        self.timeout = None
+        self.closed = False
+
+    def bind(self, addr):
+        pass
+
+    def send(self, data):
+        self.sent.append(data)
+        return len(data)
+
+    def recv(self, size):
+        if not self.replies:
+            raise OSError(errno.EAGAIN, 'Again')
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def setsockopt(self, level, option, value):
+        self.groups.append(value)
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def close(self):
+        self.closed = True
+
+
+def fake_genl_sockets(monkeypatch, *sockets):
+    sockets = list(sockets)
+    monkeypatch.setattr(socket, 'socket', lambda *args: sockets.pop(0))
+
+
+def test_genl_family():
+    sock = FakeGenlSocket(GENL_FAMILY_REPLY)
+    family, groups = networkd_dispatcher.genl_family(sock, 'nl80211')
+    assert family == NL80211_ID
+    assert groups == {'config': 5, 'mlme': 7}
+    assert sock.sent == [struct.pack('=IHHII', 32, 0x10, 1, 1, 0) +
+                         struct.pack('=BBH', 3, 1, 0) + nla(2, b'nl80211\0')]
+    # families which are not registered
+    error = struct.pack('=IHHII', 36, 2, 0, 1, 0) + struct.pack('=i', -2)
+    with pytest.raises(OSError):
+        networkd_dispatcher.genl_family(FakeGenlSocket(error + b'\0' * 16),
+                                        'nl80211')
+    done = struct.pack('=IHHII', 16, 3, 0, 1, 0)
+    with pytest.raises(ValueError):
+        networkd_dispatcher.genl_family(FakeGenlSocket(done), 'nl80211')
+    # replies to other requests are skipped
+    sock = FakeGenlSocket(GENL_FAMILY_REPLY.replace(
+        struct.pack('=I', 1), struct.pack('=I', 9), 1), GENL_FAMILY_REPLY)
+    assert networkd_dispatcher.genl_family(sock, 'nl80211')[0] == NL80211_ID
+    assert not sock.replies
+
+
+def test_EssidCache(monkeypatch):
+    cmd = FakeGenlSocket(GENL_FAMILY_REPLY)
+    events = FakeGenlSocket()
+    fake_genl_sockets(monkeypatch, cmd, events)
+    monkeypatch.setattr(socket, 'if_nametoindex',
+                        {'wlan0': 3, 'wlan1': 4}.__getitem__)
+    cache = networkd_dispatcher.EssidCache()
+    assert events.groups == [5, 7]
+    assert not events.blocking
+    assert cmd.timeout == networkd_dispatcher.GENL_TIMEOUT
+
+    def interface(idx, ssid=None):
+        attrs = nla(3, struct.pack('=I', idx))
+        if ssid is not None:
+            attrs += nla(52, ssid)
+        return genl_msg(NL80211_ID, 7, attrs, len(cmd.sent) + 1)
+    cmd.replies = [interface(3, b'caf\xc3\xa9')]
+    assert cache.get('wlan0') == 'caf\xe9'
+    assert cmd.sent[1][16:] == (struct.pack('=BBH', 5, 1, 0) +
+                                nla(3, struct.pack('=I', 3)))
+    assert cache.get('wlan0') == 'caf\xe9'
+    # not connected
+    cmd.replies = [interface(4)]
+    assert cache.get('wlan1') == ''
+    assert len(cmd.sent) == 3
+    assert repr(cache) == '<EssidCache(interfaces=2, hits=1, misses=2)>'
+    # association changes invalidate the ESSID of their interface
+    events.replies = [genl_msg(0x10, 1, b''),
+                      genl_msg(NL80211_ID, 48, nla(3, struct.pack('=I', 3)))]
+    cmd.replies = [interface(3, b'work')]
+    assert cache.get('wlan1') == ''
+    assert cache.get('wlan0') == 'work'
+    assert len(cmd.sent) == 4
+    # events without an interface, or lost events, invalidate all of them
+    for event in (genl_msg(NL80211_ID, 8, b''),
+                  OSError(errno.ENOBUFS, 'No buffer space available')):
+        events.replies = [event]
+        cmd.replies = [interface(4)]
+        assert cache.get('wlan1') == ''
+        assert repr(cache).startswith('<EssidCache(interfaces=1, ')
+    events.replies = [OSError(errno.EPERM, 'Operation not permitted')]
+    with pytest.raises(OSError):
+        cache.get('wlan0')
+    cache.close()
+    assert cmd.closed and events.closed
+    # nl80211 is not available
+    cmd = FakeGenlSocket(GENL_FAMILY_REPLY.replace(b'mlme', b'mlmX'))
+    events = FakeGenlSocket()
+    fake_genl_sockets(monkeypatch, cmd, events)
+    with pytest.raises(KeyError):
+        networkd_dispatcher.EssidCache()
+    assert cmd.closed and events.closed
+    cmd = FakeGenlSocket(OSError(errno.EPERM, 'Operation not permitted'))
+    fake_genl_sockets(monkeypatch, cmd)
+    with pytest.raises(OSError):
+        networkd_dispatcher.EssidCache()
+    assert cmd.closed
+
+
+def test_wlan_essid_cache(monkeypatch, caplog):
+    monkeypatch.setattr(networkd_dispatcher, 'WLAN_ESSIDS',
+                        networkd_dispatcher.UNRESOLVED)
+    fake_genl_sockets(monkeypatch, FakeGenlSocket(GENL_FAMILY_REPLY),
+                      FakeGenlSocket())
+    cache = networkd_dispatcher.wlan_essid_cache()
+    assert isinstance(cache, networkd_dispatcher.EssidCache)
+    assert networkd_dispatcher.wlan_essid_cache() is cache
+    monkeypatch.setattr(networkd_dispatcher, 'WLAN_ESSIDS',
+                        networkd_dispatcher.UNRESOLVED)
+    fake_genl_sockets(monkeypatch, FakeGenlSocket(OSError(
+        errno.ENOENT, 'No such file or directory')))
+    caplog.set_level(logging.INFO)
+    assert networkd_dispatcher.wlan_essid_cache() is None
+    assert networkd_dispatcher.WLAN_ESSIDS is None
+    _, _, info = caplog.record_tuples[0]
+    assert info == ('Reading ESSIDs with wireless tools, nl80211 is not '
+                    'usable: [Errno 2] No such file or directory')
+
+
+def test_get_wlan_essid_nl80211(monkeypatch, caplog):
+    cache = mock.Mock()
+    cache.get.return_value = 'home'
+    monkeypatch.setattr(networkd_dispatcher, 'WLAN_ESSIDS', cache)
+    assert networkd_dispatcher.get_wlan_essid('wlan0') == 'home'
+    cache.get.assert_called_with('wlan0')
+    # falls back to the wireless tools
+    cache.get.side_effect = OSError(errno.ENODEV, 'No such device')
+    monkeypatch.setattr('networkd_dispatcher.IWCONFIG', None)
+    monkeypatch.setattr('networkd_dispatcher.IW', '/usr/bin/iw')
+    monkeypatch.setattr(subprocess, 'check_output',
+                        lambda cmd: get_datafile('iw'))
+    assert networkd_dispatcher.get_wlan_essid('wlan0') == 'ssid123'
+    _, _, warn = caplog.record_tuples[0]
+    assert warn == ('Unable to retrieve ESSID for wireless interface wlan0 '
+                    'from nl80211: [Errno 19] No such device')
 
 
 @patch('subprocess.check_output')
@@ -100,6 +485,7 @@ def test_get_networkctl_list(mock_subprocess, monkeypatch,
 @patch('networkd_dispatcher.iw_get_ssid')
 def test_get_wlan_ssid(mock_iw_get_ssid, mock_iwconfig_get_ssid,
                        monkeypatch, caplog):
+    monkeypatch.setattr(networkd_dispatcher, 'WLAN_ESSIDS', None)
     iface = 'wlp0s1'
     monkeypatch.setattr('networkd_dispatcher.IWCONFIG', None)
     monkeypatch.setattr('networkd_dispatcher.IW', None)
@@ -121,6 +507,7 @@ def test_get_wlan_ssid(mock_iw_get_ssid, mock_iwconfig_get_ssid,
 
 
 def test_iwconfig_get_ssid(monkeypatch):
+    monkeypatch.setattr(networkd_dispatcher, 'WLAN_ESSIDS', None)
     expected = 'OMG_ssid'
     monkeypatch.setattr('networkd_dispatcher.IW', None)
     monkeypatch.setattr('networkd_dispatcher.IWCONFIG', '/usr/bin/iwconfig')
@@ -130,6 +517,7 @@ def test_iwconfig_get_ssid(monkeypatch):
 
 
 def test_iw_get_ssid(monkeypatch, caplog):
+    monkeypatch.setattr(networkd_dispatcher, 'WLAN_ESSIDS', None)
     expected = 'ssid123'
     monkeypatch.setattr('networkd_dispatcher.IW', '/usr/bin/iw')
     monkeypatch.setattr('networkd_dispatcher.IWCONFIG', None)
@@ -207,6 +595,1281 @@ def test_scripts_in_path(monkeypatch, scripts_etc, scripts_usr,
 
 
 
+@pytest.fixture()
+def script_path(tmp_path, monkeypatch):
+    """Two script directories in PATH notation, where scripts are checked for
+    being executable only"""
+    for base in ('etc', 'usr'):
+        tmp_path.joinpath(base).mkdir()
+    monkeypatch.setattr(networkd_dispatcher, 'check_script',
+                        lambda p: os.access(p, os.X_OK))
+    return '%s/etc:%s/usr' % (tmp_path, tmp_path)
+
+
+def make_script(dirname, filename, mode=0o755):
+    if not os.path.isdir(dirname):
+        os.mkdir(dirname)
+    pathname = os.path.join(dirname, filename)
+    with open(pathname, 'w') as fh:
+        fh.write('#!/bin/sh\n')
+    os.chmod(pathname, mode)
+    return pathname
+
+
+def test_Inotify(tmp_path, monkeypatch):
+    inotify = networkd_dispatcher.Inotify()
+    assert inotify.read_events() == []
+    wd = inotify.add_watch(str(tmp_path), networkd_dispatcher.IN_CREATE)
+    make_script(str(tmp_path), 'script')
+    assert inotify.read_events() == [(wd, networkd_dispatcher.IN_CREATE,
+                                      'script')]
+    with pytest.raises(OSError):
+        inotify.add_watch(str(tmp_path / 'missing'),
+                          networkd_dispatcher.IN_CREATE)
+
+    def read(fd, size):
+        raise OSError(errno.EBADF, 'Bad file descriptor')
+    monkeypatch.setattr(os, 'read', read)
+    with pytest.raises(OSError):
+        inotify.read_events()
+    # inotify_init1() failure
+    libc = mock.MagicMock()
+    libc.inotify_init1.return_value = -1
+    monkeypatch.setattr(ctypes, 'CDLL', lambda *a, **k: libc)
+    with pytest.raises(OSError):
+        networkd_dispatcher.Inotify()
+
+
+def test_ScriptIndex(script_path, monkeypatch):
+    etc, usr = script_path.split(':')
+    make_script(etc + '/routable.d', '50-etc')
+    usr_script = make_script(usr + '/routable.d', '10-usr')
+    checked = []
+    check_script = networkd_dispatcher.check_script
+    monkeypatch.setattr(networkd_dispatcher, 'check_script',
+                        lambda p: checked.append(p) or check_script(p))
+    index = networkd_dispatcher.ScriptIndex(script_path)
+    assert index.inotify is not None
+    expected = [usr + '/routable.d/10-usr', etc + '/routable.d/50-etc']
+    # built at startup
+    assert index.get('routable.d') == expected
+    assert (index.hits, index.misses) == (1, 0)
+    assert index.get('off.d') == []
+    assert index.get('off.d') == []
+    assert (index.hits, index.misses) == (2, 1)
+    assert repr(index) == ('<ScriptIndex(%r, hits=2, misses=1)>' %
+                           script_path)
+    # only changed scripts are checked again
+    del checked[:]
+    os.chmod(usr_script, 0o644)
+    assert index.get('routable.d') == expected[1:]
+    assert checked == [usr_script]
+    # new script directory
+    make_script(usr + '/off.d', '10-off')
+    assert index.get('off.d') == [usr + '/off.d/10-off']
+    # removed and recreated script directory
+    os.unlink(usr + '/off.d/10-off')
+    os.rmdir(usr + '/off.d')
+    assert index.get('off.d') == []
+    make_script(usr + '/off.d', '20-off')
+    assert index.get('off.d') == [usr + '/off.d/20-off']
+    # event queue overflow
+    monkeypatch.setattr(index.inotify, 'read_events',
+                        lambda: [(-1, networkd_dispatcher.IN_Q_OVERFLOW, '')])
+    misses = index.misses
+    assert index.get('off.d') == [usr + '/off.d/20-off']
+    assert index.misses == misses + 1
+    # events for unknown watches are ignored
+    monkeypatch.setattr(index.inotify, 'read_events',
+                        lambda: [(-1, networkd_dispatcher.IN_CREATE, 'x')])
+    assert index.get('off.d') == [usr + '/off.d/20-off']
+    assert index.misses == misses + 1
+
+
+def test_ScriptIndex_mtime(script_path, monkeypatch, caplog):
+    def no_inotify():
+        raise OSError(errno.EMFILE, 'Too many open files')
+    monkeypatch.setattr(networkd_dispatcher, 'Inotify', no_inotify)
+    etc, usr = script_path.split(':')
+    make_script(etc + '/routable.d', '50-etc')
+    caplog.set_level(logging.INFO)
+    index = networkd_dispatcher.ScriptIndex(script_path + ':/nonexistent')
+    assert index.inotify is None
+    _, _, info = caplog.record_tuples[0]
+    assert info == ('Checking script directory mtimes, inotify is not '
+                    'usable: [Errno 24] Too many open files')
+    assert index.get('routable.d') == [etc + '/routable.d/50-etc']
+    assert index.hits == 1
+    make_script(etc + '/routable.d', '10-etc')
+    os.utime(etc + '/routable.d', (0, 0))
+    assert index.get('routable.d') == [etc + '/routable.d/10-etc',
+                                       etc + '/routable.d/50-etc']
+    assert index.misses == 1
+
+
+def test_ScriptIndex_removed_base(script_path):
+    etc, usr = script_path.split(':')
+    index = networkd_dispatcher.ScriptIndex(script_path)
+    make_script(usr + '/off.d', '10-off')
+    assert index.get('off.d') == [usr + '/off.d/10-off']
+    os.unlink(usr + '/off.d/10-off')
+    os.rmdir(usr + '/off.d')
+    os.rmdir(usr)
+    # falls back to directory mtimes
+    assert index.get('off.d') == []
+    os.mkdir(usr)
+    make_script(usr + '/off.d', '10-off')
+    assert index.get('off.d') == [usr + '/off.d/10-off']
+
+
+def test_transition_routes(script_path):
+    etc, usr = script_path.split(':')
+    for dirname in (etc + '/off->routable.d', usr + '/off->routable.d',
+                    usr + '/degraded->routable.d', usr + '/->routable.d',
+                    usr + '/routable.d', usr + '/off->routable'):
+        os.mkdir(dirname)
+    assert networkd_dispatcher.transition_routes(
+        script_path + ':/nonexistent') == {
+            ('off', 'routable'): 'off->routable.d',
+            ('degraded', 'routable'): 'degraded->routable.d'}
+
+
+def test_merge_scripts():
+    assert networkd_dispatcher.merge_scripts(
+        ['/usr/routable.d/10-a', '/etc/routable.d/30-c'],
+        ['/etc/off->routable.d/20-b', '/usr/off->routable.d/30-c']) == [
+            '/usr/routable.d/10-a', '/etc/off->routable.d/20-b',
+            '/etc/routable.d/30-c', '/usr/off->routable.d/30-c']
+
+
+def test_ScriptIndex_routes(script_path, monkeypatch):
+    etc, usr = script_path.split(':')
+    make_script(etc + '/off->routable.d', '10-etc')
+    index = networkd_dispatcher.ScriptIndex(script_path)
+    routes = index.routes()
+    assert routes == {('off', 'routable'): 'off->routable.d'}
+    assert index.get('off->routable.d') == [etc + '/off->routable.d/10-etc']
+    # kept until a script subdirectory is added or removed
+    make_script(etc + '/routable.d', '10-etc')
+    assert index.routes() == routes
+    make_script(usr + '/degraded->routable.d', '10-usr')
+    assert index.routes() == {
+        ('off', 'routable'): 'off->routable.d',
+        ('degraded', 'routable'): 'degraded->routable.d'}
+    routes = index.routes()
+    assert index.routes() is routes
+    # event queue overflow
+    monkeypatch.setattr(index.inotify, 'read_events',
+                        lambda: [(-1, networkd_dispatcher.IN_Q_OVERFLOW, '')])
+    assert index.routes() is not routes
+    # listed for each lookup without inotify
+    monkeypatch.setattr(networkd_dispatcher, 'Inotify', mock.MagicMock(
+        side_effect=OSError(errno.EMFILE, 'Too many open files')))
+    index = networkd_dispatcher.ScriptIndex(script_path)
+    routes = index.routes()
+    assert index.routes() is not routes
+    assert index.routes() == routes
+
+
+def test_group_scripts(script_path):
+    etc, usr = script_path.split(':')
+    scripts = [make_script(usr + '/routable.d', '10-usr'),
+               make_script(etc + '/routable.d', '20-etc'),
+               make_script(etc + '/routable.d', '30-etc'),
+               make_script(usr + '/routable.d', '40-usr'),
+               make_script(etc + '/routable.d', '50-etc')]
+    assert (networkd_dispatcher.group_scripts(scripts) ==
+            [[s] for s in scripts])
+    # scripts from etc may run concurrently
+    make_script(etc + '/routable.d', networkd_dispatcher.PARALLEL_MARKER,
+                0o644)
+    assert (networkd_dispatcher.group_scripts(scripts) ==
+            [scripts[0:1], scripts[1:3], scripts[3:4], scripts[4:5]])
+    # the marker is not a script
+    assert (networkd_dispatcher.scripts_in_path(script_path, 'routable.d') ==
+            scripts)
+
+
+def test_group_scripts_index(script_path, monkeypatch):
+    etc, usr = script_path.split(':')
+    scripts = [make_script(etc + '/routable.d', '10-etc'),
+               make_script(etc + '/routable.d', '20-etc'),
+               make_script(usr + '/routable.d', '30-usr')]
+    index = networkd_dispatcher.ScriptIndex(script_path)
+    index.get('routable.d')
+    markers = networkd_dispatcher.MarkerCache(
+        networkd_dispatcher.PARALLEL_MARKER, index)
+    assert (networkd_dispatcher.group_scripts(scripts, markers) ==
+            [[s] for s in scripts])
+    assert repr(markers) == "<MarkerCache('.parallel', dirs=2)>"
+    # markers are only looked for again once the index saw them change
+    make_script(etc + '/routable.d', networkd_dispatcher.PARALLEL_MARKER,
+                0o644)
+    stat = mock.Mock(side_effect=os.stat)
+    monkeypatch.setattr(os, 'stat', stat)
+    assert (networkd_dispatcher.group_scripts(scripts, markers) ==
+            [[s] for s in scripts])
+    stat.assert_not_called()
+    index.get('routable.d')
+    stat.reset_mock()
+    assert (networkd_dispatcher.group_scripts(scripts, markers) ==
+            [scripts[0:2], scripts[2:3]])
+    assert stat.call_count == 1
+
+
+def test_split_batch_scripts(tmp_path):
+    for name in ('a', 'b'):
+        (tmp_path / name).mkdir()
+    (tmp_path / 'b' / networkd_dispatcher.BATCH_MARKER).touch()
+    scripts = [str(tmp_path / 'a' / '10-x'), str(tmp_path / 'b' / '20-y'),
+               str(tmp_path / 'a' / '30-z')]
+    assert networkd_dispatcher.split_batch_scripts(scripts) == (
+        [scripts[0], scripts[2]], [scripts[1]])
+    # markers are looked for again once the index reports a change
+    index = mock.Mock()
+    index.version.return_value = 1
+    markers = networkd_dispatcher.MarkerCache(
+        networkd_dispatcher.BATCH_MARKER, index)
+    assert networkd_dispatcher.split_batch_scripts(scripts, markers) == (
+        [scripts[0], scripts[2]], [scripts[1]])
+    (tmp_path / 'b' / networkd_dispatcher.BATCH_MARKER).unlink()
+    assert networkd_dispatcher.split_batch_scripts(scripts, markers) == (
+        [scripts[0], scripts[2]], [scripts[1]])
+    index.version.return_value = 2
+    assert networkd_dispatcher.split_batch_scripts(scripts, markers) == (
+        scripts, [])
+
+
+def test_parse_limits():
+    limits = networkd_dispatcher.parse_limits(
+        networkd_dispatcher.NO_LIMITS,
+        {'timeout': 2.5, 'cpu': 10, 'memory': 1 << 28, 'nice': 10,
+         'ioclass': 'idle', 'scope': True,
+         'properties': {'MemoryMax': '256M'}})
+    assert limits.timeout == 2.5
+    assert limits.ioclass == 'idle'
+    assert limits.ioprio is None
+    assert networkd_dispatcher.parse_limits(limits, {'timeout': None}) == (
+        limits._replace(timeout=None))
+    for fields in ({'timeout': '5'}, {'nice': True}, {'ioclass': 'fast'},
+                   {'properties': []}, {'unknown': 1}):
+        with pytest.raises(ValueError):
+            networkd_dispatcher.parse_limits(limits, fields)
+
+
+def test_limited_argv(monkeypatch, caplog):
+    for name in ('PRLIMIT', 'NICE', 'IONICE', 'SYSTEMD_RUN'):
+        monkeypatch.setattr(networkd_dispatcher, name,
+                            '/usr/bin/' + name.lower().replace('_', '-'))
+    limited_argv = networkd_dispatcher.limited_argv
+    no_limits = networkd_dispatcher.NO_LIMITS
+    assert limited_argv('/s', no_limits) == '/s'
+    assert limited_argv('/s', no_limits._replace(timeout=5)) == '/s'
+    assert limited_argv('/s', no_limits._replace(
+        cpu=10, memory=1024, nice=5, ioclass='idle', scope=True,
+        properties={'MemoryMax': '1M', 'CPUQuota': '20%'})) == [
+        '/usr/bin/systemd-run', '--scope', '--quiet', '--collect',
+        '-p', 'CPUQuota=20%', '-p', 'MemoryMax=1M', '--',
+        '/usr/bin/prlimit', '--cpu=10', '--as=1024',
+        '/usr/bin/nice', '-n', '5',
+        '/usr/bin/ionice', '-c', '3', '/s']
+    assert limited_argv('/s', no_limits._replace(ioprio=7)) == [
+        '/usr/bin/ionice', '-c', '2', '-n', '7', '/s']
+    # limits whose commands are missing are skipped
+    monkeypatch.setattr(networkd_dispatcher, 'PRLIMIT', None)
+    caplog.clear()
+    assert limited_argv('/s', no_limits._replace(cpu=10, nice=1)) == [
+        '/usr/bin/nice', '-n', '1', '/s']
+    _, _, warn = caplog.record_tuples[0]
+    assert warn == ("Unable to find prlimit command; not applying limits to "
+                    "'/s'")
+
+
+def test_LimitsCache(tmp_path, caplog):
+    cache = networkd_dispatcher.LimitsCache(timeout=30)
+    script = str(tmp_path / 'a')
+    path = str(tmp_path / networkd_dispatcher.LIMITS_FILE)
+    assert cache.get(script) == networkd_dispatcher.NO_LIMITS._replace(
+        timeout=30)
+    assert repr(cache) == '<LimitsCache(timeout=30, dirs=1)>'
+    with open(path, 'w') as fh:
+        json.dump({'nice': 10, 'scripts': {'b': {'timeout': None,
+                                                 'cpu': 5}}}, fh)
+    os.utime(path, (1, 1))
+    assert cache.get(script).nice == 10
+    assert cache.get(script).timeout == 30
+    limits = cache.get(str(tmp_path / 'b'))
+    assert (limits.nice, limits.timeout, limits.cpu) == (10, None, 5)
+    # reread when changed
+    with open(path, 'w') as fh:
+        fh.write('[]')
+    os.utime(path, (2, 2))
+    caplog.clear()
+    assert cache.get(script).nice is None
+    _, _, err = caplog.record_tuples[0]
+    assert err.startswith('Ignoring invalid limits file %r: ' % path)
+
+
+def test_parse_match():
+    match = networkd_dispatcher.parse_match(
+        networkd_dispatcher.MATCH_ALL,
+        {'iface': ['wg*', 'tun?'], 'type': 'wireguard',
+         'state_type': 'operational'})
+    assert match.iface.match('wg0') and match.iface.match('tun1')
+    assert not match.iface.match('tun10')
+    assert not match.iface.match('eth0')
+    assert match.type == {'wireguard'}
+    assert match.state_type == {'operational'}
+    assert match.essid is None
+    assert not networkd_dispatcher.parse_match(
+        match, {'iface': []}).iface.match('wg0')
+    for fields in ({'type': 1}, {'iface': ['a', None]},
+                   {'state_type': 'carrier'}, {'name': 'eth0'}):
+        with pytest.raises(ValueError):
+            networkd_dispatcher.parse_match(networkd_dispatcher.MATCH_ALL,
+                                            fields)
+
+
+def test_script_matches():
+    iface = networkd_dispatcher.Interface(3, 'wlan0', 'wlan', 'routable',
+                                          'configured')
+    matches = networkd_dispatcher.script_matches
+    match = networkd_dispatcher.MATCH_ALL
+    assert matches(match, iface, 'administrative')
+    match = networkd_dispatcher.parse_match(match, {
+        'iface': 'wlan*', 'type': ['wlan', 'ether'],
+        'state_type': 'operational', 'essid': 'home*'})
+    assert matches(match, iface, 'operational')
+    assert matches(match, iface, 'operational', 'home-5G')
+    assert not matches(match, iface, 'operational', 'work')
+    assert not matches(match, iface, 'operational', '')
+    assert not matches(match, iface, 'administrative')
+    iface.type = 'wwan'
+    assert not matches(match, iface, 'operational')
+    iface.type = 'wlan'
+    iface.name = 'wlp2s0'
+    assert not matches(match, iface, 'operational')
+
+
+def test_MatchCache(tmp_path, caplog):
+    cache = networkd_dispatcher.MatchCache()
+    iface = networkd_dispatcher.Interface(3, 'wg0', 'wireguard', 'routable',
+                                          'configured')
+    scripts = [str(tmp_path / 'a'), str(tmp_path / 'b'),
+               str(tmp_path / 'other' / 'c')]
+
+    def select():
+        selected, excluded = cache.select(cache.get(scripts), iface,
+                                          'operational')
+        return ([script for script, _ in selected],
+                [script for script, _ in excluded])
+    assert select() == (scripts, [])
+    assert repr(cache) == '<MatchCache(dirs=2)>'
+    path = str(tmp_path / networkd_dispatcher.MATCH_FILE)
+    with open(path, 'w') as fh:
+        json.dump({'type': 'ether', 'scripts': {'b': {'type': 'wireguard',
+                                                      'iface': 'wg*'}}}, fh)
+    os.utime(path, (1, 1))
+    assert select() == (scripts[1:], scripts[:1])
+    iface.name = 'wg-home'
+    assert select() == (scripts[1:], scripts[:1])
+    iface.name = 'eth0'
+    assert select() == (scripts[2:], scripts[:2])
+    # filters are looked up once for several selections
+    matches = cache.get(scripts)
+    assert [match for _, match in matches][2] is networkd_dispatcher.MATCH_ALL
+    assert cache.select(matches, iface, 'operational', 'home') == (
+        matches[2:], matches[:2])
+    # reread when changed
+    with open(path, 'w') as fh:
+        fh.write('{"scripts": []}')
+    os.utime(path, (2, 2))
+    caplog.clear()
+    assert select() == (scripts, [])
+    _, _, err = caplog.record_tuples[0]
+    assert err.startswith('Ignoring invalid match file %r: ' % path)
+
+
+def test_ScriptDirCache_index(tmp_path, monkeypatch):
+    # files are only read again once the script index saw them change
+    (tmp_path / 'routable.d').mkdir()
+    script = str(tmp_path / 'routable.d' / 'a')
+    path = str(tmp_path / 'routable.d' / networkd_dispatcher.LIMITS_FILE)
+    with open(path, 'w') as fh:
+        json.dump({'nice': 10}, fh)
+    index = networkd_dispatcher.ScriptIndex(str(tmp_path))
+    cache = networkd_dispatcher.LimitsCache(index=index)
+    assert cache.get(script).nice == 10
+    stat = mock.Mock(side_effect=os.stat)
+    monkeypatch.setattr(os, 'stat', stat)
+    assert cache.get(script).nice == 10
+    stat.assert_not_called()
+    with open(path, 'w') as fh:
+        json.dump({'nice': 5}, fh)
+    assert cache.get(script).nice == 10
+    index.get('routable.d')
+    assert cache.get(script).nice == 5
+    # and reread from their mtime in directories not watched
+    other = str(tmp_path / 'other' / 'a')
+    assert index.version(os.path.dirname(other)) is None
+    stat.reset_mock()
+    assert cache.get(other) == networkd_dispatcher.NO_LIMITS
+    assert cache.get(other) == networkd_dispatcher.NO_LIMITS
+    assert stat.call_count == 2
+    # or once their queue overflowed
+    version = index.version(os.path.dirname(script))
+    monkeypatch.setattr(index.inotify, 'read_events',
+                        lambda: [(-1, networkd_dispatcher.IN_Q_OVERFLOW, '')])
+    index.get('routable.d')
+    assert index.version(os.path.dirname(script)) != version
+
+
+def test_exit_status():
+    assert networkd_dispatcher.exit_status(0) == 0
+    assert networkd_dispatcher.exit_status(3 << 8) == 3
+    assert networkd_dispatcher.exit_status(9) == -9
+
+
+class FakeChildWatches():
+    """Stands in for GLib child watches and timeouts, recording callbacks so
+    that tests can run them"""
+
+    def __init__(self):
+        self.watches = {}
+        self.timeouts = {}
+        self.removed = []
+
+    def child_watch_add(self, priority, pid, function, data):
+        self.watches[pid] = (function, data)
+        return pid
+
+    def timeout_add(self, interval, function, *data):
+        self.timeouts[len(self.timeouts) + 1] = (interval, function, data)
+        return len(self.timeouts)
+
+    def source_remove(self, tag):
+        self.removed.append(tag)
+
+    def exit(self, pid, status=0):
+        function, data = self.watches.pop(pid)
+        function(pid, status, data)
+
+
+@pytest.fixture()
+def child_watches(monkeypatch):
+    watches = FakeChildWatches()
+    for name in ('child_watch_add', 'timeout_add', 'source_remove'):
+        monkeypatch.setattr(glib, name, getattr(watches, name))
+    return watches
+
+
+@pytest.fixture()
+def popen(monkeypatch):
+    """Replaces subprocess.Popen, returning a list of the scripts started"""
+    started = []
+
+    def fake_popen(script, env=None):
+        if script.endswith('missing'):
+            raise OSError(errno.ENOENT, 'No such file or directory')
+        proc = mock.MagicMock()
+        proc.pid = len(started) + 100
+        proc.returncode = None
+        proc.script = script
+        started.append(proc)
+        return proc
+    monkeypatch.setattr(subprocess, 'Popen', fake_popen)
+    return started
+
+
+def test_HookRunner(child_watches, popen, caplog):
+    runner = networkd_dispatcher.HookRunner(max_workers=2)
+    done = mock.Mock()
+    runner.submit('eth0', [['a'], ['b', 'c']], {}, done)
+    runner.submit('eth0', [['d']], {})
+    runner.submit('wlan0', [['e']], {})
+    # one script per interface, as b must wait for a
+    assert [p.script for p in popen] == ['a', 'e']
+    assert repr(runner) == ('<HookRunner(max_workers=2, running=2, '
+                            'waiting=0)>')
+    child_watches.exit(100)
+    assert [p.script for p in popen] == ['a', 'e', 'b']
+    assert popen[0].returncode == 0
+    # group of b and c, limited to two scripts at once
+    child_watches.exit(101)
+    assert [p.script for p in popen] == ['a', 'e', 'b', 'c']
+    # d waits for the group to complete
+    caplog.clear()
+    child_watches.exit(103, 1 << 8)
+    assert [p.script for p in popen] == ['a', 'e', 'b', 'c']
+    done.assert_not_called()
+    _, _, warn = caplog.record_tuples[0]
+    assert warn == "Exit status 1 from script 'c' for interface eth0"
+    assert caplog.records[0].rc == 1
+    assert caplog.records[0].script == 'c'
+    child_watches.exit(102)
+    assert [p.script for p in popen] == ['a', 'e', 'b', 'c', 'd']
+    done.assert_called_once_with()
+    child_watches.exit(104)
+    assert runner.running == 0
+    assert runner._jobs == {}
+
+
+def test_HookRunner_metrics(child_watches, popen):
+    metrics = networkd_dispatcher.Metrics()
+    runner = networkd_dispatcher.HookRunner(max_workers=1, metrics=metrics)
+    runner.submit('eth0', [['a']], {})
+    runner.submit('wlan0', [['b']], {})
+    assert runner.backlog == 1
+    child_watches.exit(100, 2 << 8)
+    assert runner.backlog == 0
+    assert metrics.scripts['a'].exits == {2: 1}
+    assert metrics.scripts['a'].duration.count == 1
+    assert 'b' not in metrics.scripts
+
+
+def test_HookRunner_errors(child_watches, popen, caplog):
+    runner = networkd_dispatcher.HookRunner(
+        max_workers=1, timeout=2.5, metrics=networkd_dispatcher.Metrics())
+    caplog.clear()
+    runner.submit('eth0', [[], ['/missing', 'a']], {})
+    _, _, err = caplog.record_tuples[0]
+    assert err == ("Unable to invoke script '/missing': [Errno 2] No such "
+                   "file or directory")
+    assert [p.script for p in popen] == ['a']
+    # timeout
+    interval, function, data = child_watches.timeouts[1]
+    assert interval == 2500
+    caplog.clear()
+    assert function(*data) is False
+    popen[0].kill.assert_called_with()
+    _, _, warn = caplog.record_tuples[0]
+    assert warn == "Killing script 'a' after timeout of 2.5 seconds"
+    assert runner.metrics.scripts['a'].timeouts == 1
+    child_watches.exit(100, 9)
+    assert popen[0].returncode == -9
+    assert child_watches.removed == [1]
+    # nothing left to run
+    runner.submit('eth0', [], {})
+    assert runner._jobs == {}
+
+
+def test_Histogram():
+    hist = networkd_dispatcher.Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        hist.observe(value)
+    assert hist.counts == [2, 1, 1]
+    assert hist.count == 4
+    assert hist.render('x') == ['x_bucket{le="0.1"} 2',
+                                'x_bucket{le="1.0"} 3',
+                                'x_bucket{le="+Inf"} 4',
+                                'x_sum 2.65',
+                                'x_count 4']
+    assert hist.render('x', 'a="b"')[0] == 'x_bucket{a="b",le="0.1"} 2'
+    assert hist.render('x', 'a="b"')[-1] == 'x_count{a="b"} 4'
+
+
+def test_Metrics():
+    metrics = networkd_dispatcher.Metrics()
+    metrics.signals_received = 3
+    metrics.signals_ignored['unknown_index'] = 1
+    metrics.script_exited('/etc/a"b', 0.02, 1)
+    metrics.script_exited('/etc/a"b', 0.02, 0)
+    metrics.script_timed_out('/etc/a"b')
+    metrics.script_filtered('/etc/a"b')
+    metrics.script_filtered('/etc/a"b')
+    metrics.plugin_called('a.py', 0.02, False, False)
+    metrics.plugin_called('a.py', 2.0, True, True)
+    lines = metrics.render({'interfaces': ('gauge', 'Known interfaces',
+                                           2)}).splitlines()
+    prefix = networkd_dispatcher.METRICS_PREFIX
+    assert lines[:3] == ['# HELP %ssignals_received_total PropertiesChanged '
+                         'signals received' % prefix,
+                         '# TYPE %ssignals_received_total counter' % prefix,
+                         '%ssignals_received_total 3' % prefix]
+    assert ('%ssignals_ignored_total{reason="unknown_index"} 1' % prefix
+            in lines)
+    assert ('%snetworkctl_seconds_count{command="status"} 0' % prefix
+            in lines)
+    assert ('%sreconcile_drift_total{kind="new_interface"} 0' % prefix
+            in lines)
+    assert ('%sscript_duration_seconds_bucket{script="/etc/a\\"b",'
+            'le="0.05"} 2' % prefix in lines)
+    assert lines[-31:-23] == [
+        '%sscript_exits_total{script="/etc/a\\"b",status="0"} 1' % prefix,
+        '%sscript_exits_total{script="/etc/a\\"b",status="1"} 1' % prefix,
+        '# HELP %sscript_timeouts_total Script runs killed after their '
+        'timeout, by script' % prefix,
+        '# TYPE %sscript_timeouts_total counter' % prefix,
+        '%sscript_timeouts_total{script="/etc/a\\"b"} 1' % prefix,
+        '# HELP %sscript_runs_filtered_total Script runs avoided because the '
+        'match filters of the script excluded the event, by script' % prefix,
+        '# TYPE %sscript_runs_filtered_total counter' % prefix,
+        '%sscript_runs_filtered_total{script="/etc/a\\"b"} 2' % prefix]
+    assert ('%splugin_duration_seconds_bucket{plugin="a.py",le="1.0"} 1'
+            % prefix in lines)
+    assert lines[-9:] == [
+        '# HELP %splugin_errors_total Plugin callbacks which raised an '
+        'exception, by plugin' % prefix,
+        '# TYPE %splugin_errors_total counter' % prefix,
+        '%splugin_errors_total{plugin="a.py"} 1' % prefix,
+        '# HELP %splugin_overruns_total Plugin callbacks abandoned as they '
+        'took longer than the plugin budget, by plugin' % prefix,
+        '# TYPE %splugin_overruns_total counter' % prefix,
+        '%splugin_overruns_total{plugin="a.py"} 1' % prefix,
+        '# HELP %sinterfaces Known interfaces' % prefix,
+        '# TYPE %sinterfaces gauge' % prefix,
+        '%sinterfaces 2' % prefix]
+    assert networkd_dispatcher.escape_label('a\\b\nc') == 'a\\\\b\\nc'
+
+
+@pytest.fixture()
+def spawn_helper(monkeypatch):
+    """A running SpawnHelper, with the GLib sources it adds recorded"""
+    sources = []
+
+    def add_source(*args):
+        sources.append(args)
+        return len(sources)
+    monkeypatch.setattr(glib, 'io_add_watch', add_source)
+    monkeypatch.setattr(glib, 'idle_add', add_source)
+    helper = networkd_dispatcher.SpawnHelper()
+    helper.sources = sources
+    yield helper
+    if helper.alive:
+        helper.sock.close()
+        helper.proc.wait()
+
+
+def write_script(tmp_path, name, body):
+    path = str(tmp_path / name)
+    with open(path, 'w') as fh:
+        fh.write('#!/bin/sh\n' + body + '\n')
+    os.chmod(path, 0o755)
+    return path
+
+
+def test_SpawnHelper(spawn_helper, tmp_path):
+    script = write_script(tmp_path, 'exit3', 'test "$FOO" = bar && exit 3')
+    proc = spawn_helper.spawn(script, {'FOO': 'bar'})
+    assert proc.pid > 0
+    assert proc.wait(timeout=10) == 3
+    assert proc.wait() == 3
+    assert repr(proc) == ('<HelperProcess(args=%r, pid=%d, returncode=3)>'
+                          % (script, proc.pid))
+    assert repr(spawn_helper) == ('<SpawnHelper(pid=%d, alive=True, '
+                                  'running=0)>' % spawn_helper.proc.pid)
+    # command lines
+    proc = spawn_helper.spawn(['/bin/sh', '-c', 'exit 4'], {})
+    assert proc.wait(timeout=10) == 4
+    # scripts which cannot be started
+    with pytest.raises(OSError) as e:
+        spawn_helper.spawn(str(tmp_path / 'missing'), {})
+    assert e.value.errno == errno.ENOENT
+    assert spawn_helper._procs == {}
+    # timeouts
+    proc = spawn_helper.spawn(write_script(tmp_path, 'sleep', 'sleep 10'),
+                              {})
+    with pytest.raises(subprocess.TimeoutExpired):
+        proc.wait(timeout=0.05)
+    proc.kill()
+    assert proc.wait() == -9
+    proc.kill()
+    # replies read while the main loop runs
+    (fd, _, _, on_readable), = spawn_helper.sources
+    assert fd == spawn_helper.sock.fileno()
+    assert on_readable(fd, glib.IO_IN) is True
+
+
+def test_SpawnHelper_watch(spawn_helper, tmp_path):
+    script = write_script(tmp_path, 'true', 'exit 0')
+    exited = []
+
+    def on_exit(pid, status, data):
+        exited.append((pid, status, data))
+    # watched before and after the process has exited
+    proc1 = spawn_helper.spawn(script, {})
+    spawn_helper.watch(proc1, on_exit, 'a')
+    proc2 = spawn_helper.spawn(script, {})
+    proc1.wait()
+    proc2.wait()
+    spawn_helper.watch(proc2, on_exit, 'b')
+    assert len(spawn_helper.sources) == 2
+    assert exited == []
+    deliver, = spawn_helper.sources[1]
+    assert deliver() is False
+    assert exited == [(proc1.pid, 0, 'a'), (proc2.pid, 0, 'b')]
+    # replies arriving while a request is sent are read
+    proc = spawn_helper.spawn(script, {})
+    time.sleep(0.2)
+    spawn_helper.spawn(script, {}).wait()
+    assert proc.returncode == 0
+    # many requests are sent while reading replies
+    procs = [spawn_helper.spawn(script, {'PAD': 'x' * 100000})
+             for _ in range(5)]
+    assert [proc.wait() for proc in procs] == [0] * 5
+
+
+@pytest.mark.parametrize('prelude', ['', 'import os\ndel os.posix_spawn\n'])
+def test_SpawnHelper_signals(prelude, monkeypatch, tmp_path):
+    # scripts start without the signals ignored or blocked by the helper,
+    # with posix_spawn or with the fork fallback
+    monkeypatch.setattr(glib, 'io_add_watch', lambda *args: 1)
+    monkeypatch.setattr(networkd_dispatcher, 'SPAWN_HELPER_SOURCE',
+                        prelude + networkd_dispatcher.SPAWN_HELPER_SOURCE)
+    helper = networkd_dispatcher.SpawnHelper()
+    script = write_script(
+        tmp_path, 'signals',
+        'ign=$(sed -n "s/^SigIgn:[[:space:]]*//p" /proc/self/status)\n'
+        'blk=$(sed -n "s/^SigBlk:[[:space:]]*//p" /proc/self/status)\n'
+        # standard signals only, the libc may reserve some realtime ones
+        'test $((0x$ign & 0x7fffffff)) -eq 0 -a '
+        '$((0x$blk & 0x7fffffff)) -eq 0')
+    assert helper.spawn(script, {}).wait(timeout=10) == 0
+    helper.sock.close()
+    helper.proc.wait()
+
+
+def test_SpawnHelper_base_env(monkeypatch, tmp_path):
+    monkeypatch.setattr(glib, 'io_add_watch', lambda *args: 1)
+    base = {'FOO': 'base', 'BAR': 'base'}
+    helper = networkd_dispatcher.SpawnHelper(base)
+    sent = []
+    send = helper._send
+    monkeypatch.setattr(helper, '_send',
+                        lambda msg: (sent.append(msg), send(msg)))
+    script = write_script(tmp_path, 'env',
+                          'test "$FOO" = bar -a "$BAR" = base')
+    # only the variables set on top of the base environment are sent
+    env = collections.ChainMap({'FOO': 'bar'}, base)
+    assert helper.spawn(script, env).wait(timeout=10) == 0
+    assert sent[-1]['env'] == {'FOO': 'bar'}
+    assert sent[-1]['overlay']
+    # other environments are sent whole
+    env = collections.ChainMap({'FOO': 'bar'}, dict(base))
+    assert helper.spawn(script, env).wait(timeout=10) == 0
+    assert sent[-1]['env'] == {'FOO': 'bar', 'BAR': 'base'}
+    assert 'overlay' not in sent[-1]
+    assert helper.spawn(script, {'FOO': 'bar'}).wait(timeout=10) == 1
+    helper.sock.close()
+    helper.proc.wait()
+
+
+def test_base_script_env(monkeypatch):
+    monkeypatch.setattr(os, 'environ', {'PATH': '/bin', 'HOME': '/root',
+                                        'LANG': 'C.UTF-8'})
+    assert networkd_dispatcher.base_script_env() == os.environ
+    assert networkd_dispatcher.base_script_env(strip=['HOME']) == {
+        'PATH': '/bin', 'LANG': 'C.UTF-8'}
+    assert networkd_dispatcher.base_script_env(
+        keep=['PATH', 'HOME', 'TERM'], strip=['HOME']) == {'PATH': '/bin'}
+    dp = Dispatcher(script_cache=False, scan=False, env_keep=['PATH'])
+    assert dp.base_env == {'PATH': '/bin'}
+    env = dp.overlay_env({'IFACE': 'eth0'})
+    assert dict(env) == {'PATH': '/bin', 'IFACE': 'eth0'}
+    assert env.maps[-1] is dp.base_env
+
+
+def test_SpawnHelper_exit(spawn_helper, tmp_path, caplog):
+    proc = spawn_helper.spawn(write_script(tmp_path, 'sleep', 'sleep 10'),
+                              {})
+    spawn_helper.watch(proc, lambda *args: None, None)
+    spawn_helper.proc.kill()
+    caplog.clear()
+    assert proc.wait() == 255
+    _, _, err = caplog.record_tuples[0]
+    assert err == ('Spawn helper exited with status -9; starting scripts '
+                   'directly')
+    _, _, warn = caplog.record_tuples[1]
+    assert warn.startswith("Lost track of script '")
+    os.kill(proc.pid, 9)
+    assert not spawn_helper.alive
+    assert spawn_helper._exited == collections.deque([proc])
+    spawn_helper.read(None)
+    with pytest.raises(OSError) as e:
+        spawn_helper.spawn('/bin/true', {})
+    assert e.value.errno == errno.EPIPE
+    # scripts are started directly instead
+    with patch.object(subprocess, 'Popen') as mock_popen:
+        networkd_dispatcher.spawn_script(spawn_helper, '/bin/true', {})
+        mock_popen.assert_called_with('/bin/true', env={})
+
+
+def test_SpawnHelper_errors(spawn_helper, monkeypatch):
+    # the helper going away while a script is started
+    monkeypatch.setattr(spawn_helper, '_send', lambda msg: None)
+    spawn_helper.sock.shutdown(socket.SHUT_WR)
+    with pytest.raises(OSError) as e:
+        spawn_helper.spawn('/bin/true', {})
+    assert e.value.errno == errno.EPIPE
+    assert spawn_helper._procs == {}
+    # killing processes
+    proc = networkd_dispatcher.HelperProcess(spawn_helper, 1, '/bin/true')
+    proc.pid = 1
+    with patch.object(os, 'kill') as mock_kill:
+        mock_kill.side_effect = OSError(errno.EPERM, 'Not permitted')
+        with pytest.raises(OSError):
+            proc.kill()
+    # failures to start the helper
+    with patch.object(subprocess, 'Popen') as mock_popen:
+        mock_popen.side_effect = OSError(errno.ENOENT, 'No such file')
+        with pytest.raises(OSError):
+            networkd_dispatcher.SpawnHelper()
+    # failures to read from the socket
+    helper = networkd_dispatcher.SpawnHelper()
+    helper.sock = mock.MagicMock(fileno=lambda: spawn_helper.sock.fileno())
+    helper.sock.recv.side_effect = OSError(errno.ECONNRESET, 'Reset')
+    with patch.object(select, 'select', lambda *args: ([1], [], [])):
+        helper.read(0)
+    assert not helper.alive
+    helper.proc.wait()
+
+
+def test_HookRunner_spawn_helper(child_watches, spawn_helper, tmp_path,
+                                 monkeypatch):
+    started = []
+    spawn = spawn_helper.spawn
+    monkeypatch.setattr(spawn_helper, 'spawn',
+                        lambda *args: started.append(spawn(*args)) or
+                        started[-1])
+    runner = networkd_dispatcher.HookRunner(max_workers=2, timeout=10,
+                                            spawn_helper=spawn_helper)
+    runner.submit('eth0', [[write_script(tmp_path, 'a', 'exit 1')]], {})
+    assert runner.running == 1
+    assert child_watches.watches == {}
+    proc, = started
+    proc.wait()
+    deliver, = spawn_helper.sources[1]
+    deliver()
+    assert runner.running == 0
+    assert proc.returncode == 1
+    assert child_watches.removed == [1]
+
+
+def write_plugin(dirname, name, body, mtime=None):
+    path = os.path.join(dirname, name)
+    with open(path, 'w') as fh:
+        fh.write(body)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+@pytest.fixture()
+def plugin_owners(monkeypatch):
+    """Makes os.stat() report files as owned by root, unless given another
+    owner by path in the returned dictionary, so that plugins are loaded
+    without running as root"""
+    owners = {}
+    real_stat = os.stat
+    stat = namedtuple('stat', 'st_mode st_uid st_gid st_size st_mtime')
+
+    def owned_stat(path, *args, **kwargs):
+        entry = real_stat(path, *args, **kwargs)
+        if not isinstance(path, str):
+            return entry
+        return stat(st_mode=entry.st_mode, st_uid=owners.get(path, 0),
+                    st_gid=0, st_size=entry.st_size, st_mtime=entry.st_mtime)
+    monkeypatch.setattr(os, 'stat', owned_stat)
+    return owners
+
+
+PLUGIN_RECORDER = """
+import json, os
+
+
+def record(event):
+    with open(os.path.join(os.path.dirname(__file__), 'events'), 'a') as fh:
+        fh.write(json.dumps([%s, event.iface, event.state, event.prior_state,
+                             event.data['ESSID']]) + '\\n')
+    event.data['ESSID'] = 'changed'
+
+
+def register(add_hook):
+    add_hook(record, %r)
+    add_hook(record, %r)
+"""
+
+
+def test_load_plugin(tmp_path):
+    path = write_plugin(str(tmp_path), 'a.py', (
+        'def register(add_hook):\n'
+        '    add_hook(len, "off")\n'
+        '    add_hook(repr, ["off", "carrier"])\n'
+        '    add_hook(str)\n'))
+    assert networkd_dispatcher.load_plugin(path) == [
+        (len, {'off'}), (repr, {'off', 'carrier'}), (str, None)]
+    path = write_plugin(str(tmp_path), 'b.py', 'x = 1\n')
+    with pytest.raises(AttributeError):
+        networkd_dispatcher.load_plugin(path)
+
+
+def test_PluginHost(tmp_path, caplog, monkeypatch, plugin_owners):
+    plugin_dir = str(tmp_path)
+    write_plugin(plugin_dir, 'a.py', PLUGIN_RECORDER % (
+        '"a"', 'routable', ['routable', 'degraded']), mtime=1000)
+    write_plugin(plugin_dir, 'b.py', (
+        'import time\n\n\n'
+        'def fail(event):\n'
+        '    raise ValueError(event.iface)\n\n\n'
+        'def register(add_hook):\n'
+        '    add_hook(fail, "routable")\n'
+        '    add_hook(lambda event: time.sleep(0.5), "routable")\n'))
+    write_plugin(plugin_dir, 'c.py', 'def register(add_hook):\n    1/\n')
+    for name in ('_d.py', '.e.py', 'f.txt'):
+        write_plugin(plugin_dir, name, 'raise ImportError\n')
+    metrics = networkd_dispatcher.Metrics()
+    caplog.set_level(logging.INFO)
+    host = networkd_dispatcher.PluginHost(plugin_dir, 0.05, metrics)
+    # plugins are loaded by the worker thread
+    host.join()
+    assert repr(host) == '<PluginHost(%r, plugins=3, queued=0)>' % (
+        plugin_dir,)
+    assert ('networkd-dispatcher', logging.ERROR,
+            "Unable to load plugin '%s/c.py'" % plugin_dir
+            ) in caplog.record_tuples
+    assert host.wants('routable') and host.wants('degraded')
+    assert not host.wants('off')
+    caplog.clear()
+    host.submit(networkd_dispatcher.PluginEvent(
+        'wlan0', 'routable', 'operational', 'degraded',
+        json.dumps({'ESSID': 'home'})))
+    host.join()
+    assert not host.busy
+    # each callback got its own data
+    with open(os.path.join(plugin_dir, 'events')) as fh:
+        assert [json.loads(line) for line in fh] == [
+            ['a', 'wlan0', 'routable', 'degraded', 'home']] * 2
+    # errors and overruns are logged and counted for the plugin
+    messages = [msg for _, _, msg in caplog.record_tuples]
+    assert ("Error in plugin 'b.py' handling interface wlan0 entering state "
+            "routable") in messages
+    assert ("Disabling plugin 'b.py' until it changes, as it did not return "
+            "within its budget of 0.05 seconds handling interface wlan0"
+            ) in messages
+    assert (metrics.plugins['b.py'].errors,
+            metrics.plugins['b.py'].overruns) == (1, 1)
+    assert metrics.plugins['a.py'].duration.count == 2
+    assert metrics.plugins['a.py'].errors == 0
+    # plugins which overran are no longer called
+    submit_events(host, 'routable')
+    assert metrics.plugins['b.py'].duration.count == 2
+    assert metrics.plugins['a.py'].duration.count == 4
+    # changed plugins are loaded again, and removed ones are dropped
+    os.unlink(os.path.join(plugin_dir, 'events'))
+    write_plugin(plugin_dir, 'a.py', PLUGIN_RECORDER % (
+        '"a2"', 'off', 'off'), mtime=2000)
+    os.unlink(os.path.join(plugin_dir, 'b.py'))
+    caplog.clear()
+    assert host.wants('off')
+    for state in ('routable', 'off'):
+        host.submit(networkd_dispatcher.PluginEvent(
+            'eth0', state, 'operational', None, json.dumps({'ESSID': ''})))
+    host.join()
+    with open(os.path.join(plugin_dir, 'events')) as fh:
+        assert [json.loads(line) for line in fh] == [
+            ['a2', 'eth0', 'off', None, '']] * 2
+    assert caplog.record_tuples == [
+        ('networkd-dispatcher', logging.INFO,
+         "Loading plugin '%s/a.py'" % plugin_dir)]
+    assert not reloaded(host, 'routable')
+    # events are dropped while too many are waiting
+    full = queue.Queue(1)
+    full.put(None)
+    monkeypatch.setattr(host, '_queue', full)
+    caplog.clear()
+    host.submit(networkd_dispatcher.PluginEvent(
+        'eth0', 'off', 'operational', None, '{}'))
+    assert host.dropped == 1
+    _, _, warn = caplog.record_tuples[0]
+    assert warn == ('Dropping plugin event for interface eth0 entering state '
+                    'off: %d events are waiting' %
+                    networkd_dispatcher.PLUGIN_QUEUE_SIZE)
+    assert host.busy
+    # changes are still seen, to be loaded before the next event
+    write_plugin(plugin_dir, 'g.txt', '')
+    assert host.wants('routable')
+    # a missing directory holds no plugins
+    caplog.set_level(logging.DEBUG)
+    host = networkd_dispatcher.PluginHost(str(tmp_path / 'missing'))
+    host.join()
+    assert host.inotify is None
+    _, _, debug = caplog.record_tuples[-1]
+    assert debug.startswith('Unable to list plugins in ')
+
+
+def submit_events(host, *states):
+    """Hand events for eth0 entering the given states to the plugins of
+    host, and wait until they are handled"""
+    for state in states:
+        host.submit(networkd_dispatcher.PluginEvent(
+            'eth0', state, 'operational', None, json.dumps({'ESSID': ''})))
+    host.join()
+
+
+def reloaded(host, state):
+    """Return whether host wants state once it loaded its plugins again"""
+    host.wants(state)
+    host.join()
+    return host.wants(state)
+
+
+@pytest.mark.parametrize('inotify', [True, False])
+def test_PluginHost_added(inotify, tmp_path, monkeypatch, plugin_owners):
+    if not inotify:
+        monkeypatch.setattr(networkd_dispatcher, 'Inotify',
+                            mock.Mock(side_effect=OSError('no inotify')))
+    plugin_dir = str(tmp_path)
+    host = networkd_dispatcher.PluginHost(plugin_dir)
+    host.join()
+    assert (host.inotify is not None) == inotify
+    # without inotify, all events are left for the worker thread to filter
+    assert host.wants('routable') != inotify
+    # plugins added to the directory are loaded before the next event
+    write_plugin(plugin_dir, 'a.py', PLUGIN_RECORDER % (
+        '"a"', 'routable', 'routable'))
+    assert host.wants('routable')
+    submit_events(host, 'routable', 'off')
+    # and loaded again once changed in place
+    with open(os.path.join(plugin_dir, 'a.py'), 'a') as fh:
+        fh.write('register = lambda add_hook: add_hook(record, "off")\n')
+    os.utime(os.path.join(plugin_dir, 'a.py'), (3000, 3000))
+    assert host.wants('off')
+    submit_events(host, 'routable', 'off')
+    assert reloaded(host, 'routable') != inotify
+    with open(os.path.join(plugin_dir, 'events')) as fh:
+        assert [json.loads(line)[2] for line in fh] == [
+            'routable', 'routable', 'off']
+
+
+def test_PluginHost_perms(tmp_path, caplog, plugin_owners):
+    plugin_dir = str(tmp_path)
+    path = write_plugin(plugin_dir, 'a.py', PLUGIN_RECORDER % (
+        '"a"', 'routable', 'routable'))
+    os.chmod(path, 0o664)
+    host = networkd_dispatcher.PluginHost(plugin_dir)
+    assert not reloaded(host, 'routable')
+    assert ('networkd-dispatcher', logging.ERROR,
+            'Unable to load plugin, check file perms: %s' % path
+            ) in caplog.record_tuples
+    # the owner is faked, so touch the plugin for the change to be seen
+    plugin_owners[path] = 1000
+    os.chmod(path, 0o644)
+    assert not reloaded(host, 'routable')
+    del plugin_owners[path]
+    os.utime(path)
+    assert reloaded(host, 'routable')
+    # plugins in a directory writable by others are not loaded either
+    os.chmod(plugin_dir, 0o777)
+    caplog.clear()
+    assert not reloaded(host, 'routable')
+    assert caplog.record_tuples == [
+        ('networkd-dispatcher', logging.ERROR,
+         'Unable to load plugin, check file perms: %s' % plugin_dir)]
+
+
+def test_PluginHost_all_states(tmp_path, monkeypatch, plugin_owners):
+    write_plugin(str(tmp_path), 'a.py', (
+        'def register(add_hook):\n'
+        '    add_hook(print)\n'))
+    owned_stat = os.stat
+
+    def stat(path, *args, **kwargs):
+        if str(path).endswith('.py'):
+            raise OSError(errno.ENOENT, 'vanished')
+        return owned_stat(path, *args, **kwargs)
+    monkeypatch.setattr(os, 'stat', stat)
+    host = networkd_dispatcher.PluginHost(str(tmp_path))
+    # vanished before it was loaded
+    assert not reloaded(host, 'off')
+    monkeypatch.setattr(os, 'stat', owned_stat)
+    host = networkd_dispatcher.PluginHost(str(tmp_path))
+    assert reloaded(host, 'off') and host.wants('anything')
+
+
+@pytest.fixture()
+def io_watches(monkeypatch):
+    """Records the GLib IO watches added, as (fd, condition, callback, args)
+    tuples by source id"""
+    watches = {}
+    sources = []
+
+    def io_add_watch(fd, priority, condition, callback, *args):
+        sources.append(fd)
+        watches[len(sources)] = (fd, condition, callback, args)
+        return len(sources)
+
+    def source_remove(source):
+        del watches[source]
+        return True
+    monkeypatch.setattr(glib, 'io_add_watch', io_add_watch)
+    monkeypatch.setattr(glib, 'source_remove', source_remove)
+    return watches
+
+
+def fire(watches, source, condition=glib.IO_IN):
+    """Call the callback of an IO watch, removing the watch if it returns
+    False like GLib"""
+    fd, _, callback, args = watches[source]
+    if not callback(fd, condition, *args):
+        del watches[source]
+
+
+def test_EventServer(tmp_path, io_watches, caplog, monkeypatch):
+    path = str(tmp_path / 'events.sock')
+    open(path, 'w').close()
+    server = networkd_dispatcher.EventServer(path, buffer_size=2)
+    assert repr(server) == '<EventServer(%r, subscribers=0)>' % path
+    (accept, _), = io_watches.items()
+    wlan0 = networkd_dispatcher.Interface(2, 'wlan0', 'wlan', 'routable',
+                                          'configured')
+    eth0 = networkd_dispatcher.Interface(3, 'eth0', 'ether', 'routable',
+                                         'configured')
+    assert not server.wants(wlan0, 'routable', 'operational')
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(5)
+    client.connect(path)
+    lines = client.makefile('rb')
+    fire(io_watches, accept)
+    assert server.subscribers == 1
+    subscriber, = server._clients
+    # all events are sent until the client subscribes
+    assert server.wants(eth0, 'off', 'administrative')
+    event = networkd_dispatcher.PluginEvent(
+        'wlan0', 'routable', 'operational', 'degraded', '{"ESSID": "home"}')
+    server.publish(wlan0, event, 'home')
+    assert json.loads(lines.readline().decode()) == {
+        'iface': 'wlan0', 'state': 'routable', 'state_type': 'operational',
+        'prior_state': 'degraded', 'data': {'ESSID': 'home'}}
+    client.sendall(b'{"state": "routable", "iface": "wlan*", '
+                   b'"essid": "home"}\n\n')
+    fire(io_watches, subscriber.read_source)
+    assert json.loads(lines.readline().decode()) == {'subscribed': True}
+    assert server.wants(wlan0, 'routable', 'operational')
+    assert not server.wants(wlan0, 'off', 'operational')
+    assert not server.wants(eth0, 'routable', 'operational')
+    server.publish(wlan0, event, 'work')
+    server.publish(eth0, event._replace(iface='eth0'), '')
+    assert server.published == 1
+    # invalid subscriptions are answered with an error, keeping the filters
+    client.sendall(b'[1]\n{"state": 1}\n{"name": "x"}\n\xff\n')
+    fire(io_watches, subscriber.read_source)
+    for _ in range(4):
+        reply = json.loads(lines.readline().decode())
+        assert reply['error'].startswith('Invalid subscription: ')
+    assert server.wants(wlan0, 'routable', 'operational')
+    # slow clients get the latest events
+    sock = subscriber.sock
+    subscriber.sock = mock.MagicMock()
+    subscriber.sock.send.side_effect = BlockingIOError
+    for essid in ('1', '2', '3', '4'):
+        server.publish(wlan0, event._replace(data='"%s"' % essid), 'home')
+    assert server.dropped == 1
+    assert io_watches[subscriber.write_source][1] == glib.IO_OUT
+    fire(io_watches, subscriber.write_source, glib.IO_OUT)
+    assert subscriber.write_source in io_watches
+    subscriber.sock = sock
+    fire(io_watches, subscriber.write_source, glib.IO_OUT)
+    assert subscriber.write_source is None
+    assert [json.loads(lines.readline().decode())['data']
+            for _ in range(3)] == ['1', '3', '4']
+    # clients are disconnected on errors
+    subscriber.sock = mock.MagicMock()
+    subscriber.sock.send.side_effect = OSError(errno.EPIPE, 'Broken pipe')
+    server.publish(wlan0, event, 'home')
+    assert server.subscribers == 0
+    assert list(io_watches) == [accept]
+    sock.close()
+    client.close()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    fire(io_watches, accept)
+    subscriber, = server._clients
+    subscriber.sock.close()
+    subscriber.sock = mock.MagicMock()
+    subscriber.sock.send.side_effect = BlockingIOError
+    server.publish(wlan0, event, 'home')
+    subscriber.sock.send.side_effect = OSError(errno.EPIPE, 'Broken pipe')
+    fire(io_watches, subscriber.write_source, glib.IO_OUT)
+    assert server.subscribers == 0
+    assert list(io_watches) == [accept]
+    client.close()
+    # nothing to accept
+    caplog.set_level(logging.DEBUG)
+    caplog.clear()
+    fire(io_watches, accept)
+    _, _, debug = caplog.record_tuples[0]
+    assert debug.startswith('Unable to accept event subscriber: ')
+    # disconnected clients
+    for _ in range(2):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        fire(io_watches, accept)
+        client.close()
+    first, second = server._clients
+    fire(io_watches, first.read_source)
+    second.sock.close()
+    second.sock = mock.MagicMock()
+    second.sock.recv.side_effect = OSError(errno.EBADF, 'Bad file descriptor')
+    fire(io_watches, second.read_source)
+    assert server.subscribers == 0
+    # too long requests
+    monkeypatch.setattr(networkd_dispatcher, 'EVENT_MAX_REQUEST', 4)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    fire(io_watches, accept)
+    client.sendall(b'{"state": "off"}')
+    caplog.clear()
+    subscriber, = server._clients
+    fire(io_watches, subscriber.read_source)
+    assert server.subscribers == 1
+    fire(io_watches, subscriber.read_source)
+    assert server.subscribers == 0
+    _, _, warn = caplog.record_tuples[0]
+    assert warn == ('Disconnecting event subscriber sending a request '
+                    'longer than 4 bytes')
+    client.close()
+    # closing
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    fire(io_watches, accept)
+    server.close()
+    assert io_watches == {}
+    assert not os.path.exists(path)
+    assert client.recv(1) == b''
+    client.close()
+    # the socket may have been removed already
+    server = networkd_dispatcher.EventServer(path)
+    os.unlink(path)
+    server.close()
+
+
+def test_EventServer_gone(tmp_path, io_watches):
+    # clients gone before the replies to their requests are sent
+    path = str(tmp_path / 'events.sock')
+    server = networkd_dispatcher.EventServer(path)
+    (accept, _), = io_watches.items()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    fire(io_watches, accept)
+    subscriber, = server._clients
+    client.sendall(b'{"state": "routable"}\n{"state": "off"}\n')
+    client.close()
+    fire(io_watches, subscriber.read_source)
+    assert server.subscribers == 0
+    assert list(io_watches) == [accept]
+    server._close(subscriber)
+    server.close()
+    assert io_watches == {}
+
+
+def test_EventServer_errors(tmp_path, io_watches):
+    with pytest.raises(OSError):
+        networkd_dispatcher.EventServer(str(tmp_path / 'missing' / 'sock'))
+    with pytest.raises(OSError):
+        networkd_dispatcher.EventServer(str(tmp_path))
+    assert io_watches == {}
+
+
 def test_parse_address_strings():
     addrs = ['123.321.132.312',
              '127.0.0.1',
@@ -233,6 +1896,7 @@ def test_get_interface_data(monkeypatch, get_networkctl_status_out,
                                 type='wlan',
                                 operational='routable',
                                 administrative='configured')
+    monkeypatch.setattr(networkd_dispatcher, 'WLAN_ESSIDS', None)
     monkeypatch.setattr('networkd_dispatcher.get_networkctl_status',
                         lambda x: get_networkctl_status_out)
     monkeypatch.setattr(subprocess, 'check_output',
@@ -241,6 +1905,413 @@ def test_get_interface_data(monkeypatch, get_networkctl_status_out,
     assert out != get_interface_data_out
 
 
+def test_SnapshotCache(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    cache = networkd_dispatcher.SnapshotCache(ttl=5)
+    assert cache.get('eth0') is None
+    snapshot = cache.put('eth0', {'Address': ['10.0.0.1']})
+    assert snapshot.status == {'Address': ['10.0.0.1']}
+    assert cache.get('eth0') is snapshot
+    assert repr(cache) == '<SnapshotCache(ttl=5, hits=1, misses=1)>'
+    # invalidated
+    cache.invalidate('eth0')
+    cache.invalidate('eth0')
+    assert cache.get('eth0') is None
+    # expired
+    cache.put('eth0', {})
+    now[0] += 5
+    assert cache.get('eth0') is None
+    # evicted once gone
+    cache.put('wlan0', {})
+    assert sorted(cache._snapshots) == ['wlan0']
+
+
+def test_InterfaceRegistry():
+    eth0 = NetworkctlListState(2, 'eth0', 'ether', 'routable', 'configured')
+    registry = InterfaceRegistry([eth0])
+    iface = registry.get('eth0')
+    assert iface == eth0
+    assert not iface != eth0
+    assert iface != eth0._replace(operational='off')
+    assert iface != 'eth0'
+    assert not iface == 'eth0'
+    assert repr(registry) == ("<InterfaceRegistry([Interface(idx=2, "
+                              "name='eth0', type='ether', "
+                              "operational='routable', "
+                              "administrative='configured')])>")
+    # known interfaces are kept as they are
+    assert registry.update([eth0._replace(operational='off')]) == 0
+    assert registry.get('eth0') is iface
+    assert iface.operational == 'routable'
+    # renamed
+    assert registry.update([eth0._replace(name='lan0')]) == 1
+    assert registry.get('eth0') is None
+    assert registry.get('lan0').idx == 2
+    # recreated with a new index, and the old index removed later
+    assert registry.update([eth0._replace(name='lan0', idx=5)]) == 1
+    new = registry.get('lan0')
+    assert registry.remove(2).idx == 2
+    assert registry.get('lan0') is new
+    assert [i.idx for i in registry] == [5]
+    assert registry.remove(5) is new
+    assert len(registry) == 0
+    with pytest.raises(KeyError):
+        registry.remove(5)
+
+
+def test_StateCache(tmp_path, monkeypatch, caplog):
+    timeouts = []
+    monkeypatch.setattr(glib, 'timeout_add_seconds',
+                        lambda interval, function: timeouts.append(function)
+                        or len(timeouts))
+    path = str(tmp_path / 'run' / 'state.json')
+    eth0 = NetworkctlListState(idx=2, name='eth0', type='ether',
+                               operational='routable',
+                               administrative='configured')
+    wlan0 = NetworkctlListState(idx=3, name='wlan0', type='wlan',
+                                operational='dormant',
+                                administrative='configured')
+    cache = networkd_dispatcher.StateCache(path)
+    # no state file yet
+    caplog.clear()
+    cache.load(InterfaceRegistry([eth0]))
+    assert caplog.record_tuples == []
+    assert cache.changed(eth0, 'operational')
+    # a state is recorded, and saved once
+    cache.record(eth0, 'operational')
+    cache.record(wlan0, 'operational')
+    cache.record(wlan0, 'administrative')
+    assert len(timeouts) == 1
+    assert not cache.changed(eth0, 'operational')
+    assert cache.changed(eth0, 'administrative')
+    assert cache.changed(eth0._replace(idx=5), 'operational')
+    assert timeouts[0]() is False
+    assert repr(cache) == ('<StateCache(path=%r, interfaces=2)>' % path)
+    # loaded again, without the interfaces which went away
+    cache = networkd_dispatcher.StateCache(path)
+    cache.load(InterfaceRegistry([eth0, wlan0._replace(idx=4)]))
+    assert not cache.changed(eth0, 'operational')
+    assert cache.changed(eth0._replace(operational='degraded'),
+                         'operational')
+    assert cache.changed(wlan0._replace(idx=4), 'operational')
+    # forgotten
+    cache.forget('eth0')
+    cache.forget('eth0')
+    assert len(timeouts) == 2
+    assert cache.changed(eth0, 'operational')
+    # never saved when read only
+    cache = networkd_dispatcher.StateCache(path, readonly=True)
+    cache.record(eth0, 'operational')
+    cache.forget('eth0')
+    assert len(timeouts) == 2
+    # invalid files
+    for content in ('{', '{"version": 2}', '{"version": 1}',
+                    '{"version": 1, "interfaces": {"a": {"b": 1}}}'):
+        with open(path, 'w') as fh:
+            fh.write(content)
+        caplog.clear()
+        cache.load(InterfaceRegistry())
+        _, _, warn = caplog.record_tuples[0]
+        assert warn.startswith('Ignoring invalid state file %r: ' % path)
+    # unreadable and unwritable files
+    os.remove(path)
+    os.mkdir(path)
+    caplog.clear()
+    cache.load(InterfaceRegistry())
+    _, _, warn = caplog.record_tuples[0]
+    assert warn.startswith('Unable to read state file %r: ' % path)
+    caplog.clear()
+    cache.save()
+    _, _, err = caplog.record_tuples[0]
+    assert err.startswith('Unable to write state file %r: ' % path)
+
+
+def test_EventRecorder(tmp_path, monkeypatch, caplog):
+    path = str(tmp_path / 'events.jsonl')
+    clock = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: clock[0])
+    recorder = networkd_dispatcher.EventRecorder(path)
+    assert repr(recorder) == '<EventRecorder(path=%r)>' % path
+    clock[0] += 0.5
+    recorder.signal('org.freedesktop.network1.Link',
+                    dbus.Dictionary({dbus.String('OperationalState'):
+                                     dbus.String('routable')}),
+                    '/org/freedesktop/network1/link/_33')
+    recorder.signal('org.freedesktop.network1.Link', '',
+                    '/org/freedesktop/network1/link/_33')
+    recorder.link_list([NetworkctlListState(3, 'eth0', 'ether', 'routable',
+                                            'configured')])
+    recorder.link_status('eth0', collections.defaultdict(
+        list, {'Address': ['1.1.1.1'], 'Type': 'ether'}))
+    recorder.close()
+    recorder.close()
+    with open(path) as fh:
+        records = [json.loads(line) for line in fh]
+    assert records[0]['kind'] == 'start'
+    assert records[0]['version'] == 1
+    assert records[0]['t'] == 0
+    assert records[1:] == [
+        {'kind': 'signal', 'typ': 'org.freedesktop.network1.Link',
+         'path': '/org/freedesktop/network1/link/_33',
+         'data': {'OperationalState': 'routable'}, 't': 0.5},
+        {'kind': 'signal', 'typ': 'org.freedesktop.network1.Link',
+         'path': '/org/freedesktop/network1/link/_33', 'data': {}, 't': 0.5},
+        {'kind': 'list', 'links': [[3, 'eth0', 'ether', 'routable',
+                                    'configured']], 't': 0.5},
+        {'kind': 'status', 'iface': 'eth0',
+         'data': {'Address': ['1.1.1.1'], 'Type': 'ether'}, 't': 0.5}]
+    # recording stops on write errors
+    recorder = networkd_dispatcher.EventRecorder(path)
+    recorder._file.close()
+    recorder._file = mock.MagicMock()
+    recorder._file.write.side_effect = OSError(errno.ENOSPC,
+                                               'No space left on device')
+    caplog.clear()
+    recorder.link_list([])
+    _, _, err = caplog.record_tuples[0]
+    assert err.startswith('Unable to write event log %r; no longer '
+                          'recording: ' % path)
+    recorder.link_list([])
+    assert len(caplog.record_tuples) == 1
+    recorder = networkd_dispatcher.EventRecorder(path)
+    recorder._file = mock.MagicMock()
+    recorder._file.close.side_effect = OSError(errno.EIO, 'I/O error')
+    recorder.close()
+    assert recorder._file is None
+
+
+class FakeMainLoop():
+    """Stands in for the GLib main loop, running idle callbacks and
+    timeouts in the order they were added until quit() is called"""
+
+    def __init__(self, monkeypatch):
+        self.sources = []
+        self.running = False
+        self.intervals = []
+        monkeypatch.setattr(glib, 'MainLoop', lambda: self)
+        monkeypatch.setattr(glib, 'idle_add', self.idle_add)
+        monkeypatch.setattr(glib, 'timeout_add', self.timeout_add)
+
+    def idle_add(self, function, *data):
+        self.sources.append((function, data))
+        return len(self.sources)
+
+    def timeout_add(self, interval, function, *data):
+        self.intervals.append(interval)
+        return self.idle_add(function, *data)
+
+    def run(self):
+        self.running = True
+        while self.running and self.sources:
+            function, data = self.sources.pop(0)
+            if function(*data):
+                self.sources.append((function, data))
+
+    def quit(self):
+        self.running = False
+
+
+def write_event_log(path, *sessions):
+    with open(path, 'a') as fh:
+        for records in sessions:
+            fh.write(json.dumps({'kind': 'start', 'version': 1,
+                                 'time': 0, 't': 0}) + '\n')
+            for record in records:
+                fh.write(json.dumps(record) + '\n')
+
+
+@patch.object(Dispatcher, 'handle_state')
+def test_EventReplay(mock_handle_state, tmp_path, monkeypatch):
+    loop = FakeMainLoop(monkeypatch)
+    monkeypatch.setattr(time, 'monotonic', lambda: 10.0)
+    path = str(tmp_path / 'events.jsonl')
+    eth0 = [3, 'eth0', 'ether', 'routable', 'configured']
+
+    def signal(t, state):
+        return {'kind': 'signal', 'typ': 'org.freedesktop.network1.Link',
+                'path': '/org/freedesktop/network1/link/_33',
+                'data': {'OperationalState': state}, 't': t}
+
+    write_event_log(path, [
+        {'kind': 'list', 'links': [eth0], 't': 0.1},
+        signal(1, 'degraded'),
+        {'kind': 'status', 'iface': 'eth0', 'data': {'Address': ['a']},
+         't': 1.1},
+        {'kind': 'status', 'iface': 'eth0', 'data': {'Address': ['b']},
+         't': 1.2},
+    ], [
+        signal(0.5, 'routable'),
+    ])
+    replay = networkd_dispatcher.EventReplay(path)
+    assert [record['t'] for record in replay.records] == [
+        0, 0.1, 1, 1.1, 1.2, 1.2, 1.7]
+    assert repr(replay) == ('<EventReplay(path=%r, records=7, '
+                            'replayed=0)>' % path)
+    # nothing recorded yet
+    assert replay.link_list() == []
+    assert replay.link_status('eth0') == {}
+    dispatcher = Dispatcher(script_cache=False, scan=False)
+    assert replay.run(dispatcher, speed=2) == 2
+    assert dispatcher.replay is replay
+    assert dispatcher.interfaces.get('eth0').idx == 3
+    assert [c[1]['operational_state']
+            for c in mock_handle_state.call_args_list] == ['degraded',
+                                                           'routable']
+    # each status is answered once, then the last one is kept
+    assert replay.link_status('eth0')['Address'] == ['a']
+    assert replay.link_status('eth0')['Address'] == ['b']
+    assert replay.link_status('eth0')['Address'] == ['b']
+    assert replay.link_list() == [NetworkctlListState(*eth0)]
+    # signals are delayed by their recorded times, at twice their rate
+    assert loop.intervals[:2] == [500, 850]
+    assert loop.intervals[-1] == networkd_dispatcher.REPLAY_POLL_MS
+    # as fast as possible, waiting for the dispatcher to become idle
+    replay = networkd_dispatcher.EventReplay(path)
+    dispatcher = Dispatcher(script_cache=False, scan=False)
+    busy = [True]
+    monkeypatch.setattr(Dispatcher, 'busy',
+                        property(lambda self: busy.pop(0) if busy else False))
+    loop.intervals = []
+    assert replay.run(dispatcher) == 2
+    assert loop.intervals == [networkd_dispatcher.REPLAY_POLL_MS]
+    assert busy == []
+    # unsupported versions
+    with open(path, 'w') as fh:
+        fh.write('\n{"kind": "start", "version": 2, "t": 0}\n')
+    with pytest.raises(ValueError):
+        networkd_dispatcher.EventReplay(path)
+
+
+def make_record(level, msg, *args, **fields):
+    record = logging.LogRecord('networkd-dispatcher', level, __file__, 1,
+                               msg, args, None)
+    record.__dict__.update(fields)
+    return record
+
+
+def test_RateLimitFilter(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    ratelimit = networkd_dispatcher.RateLimitFilter(10, burst=2)
+    # debug and info records are never suppressed
+    assert all(ratelimit.filter(make_record(logging.INFO, 'a'))
+               for _ in range(5))
+    records = [make_record(logging.WARNING, 'Exit status %r', 1)
+               for _ in range(4)]
+    allowed = [ratelimit.filter(record) for record in records]
+    assert allowed == [True, True, False, False]
+    # other messages are limited separately
+    assert ratelimit.filter(make_record(logging.WARNING, 'Exit status %r', 2))
+    assert repr(ratelimit) == ('<RateLimitFilter(interval=10, burst=2, '
+                               'suppressed=2)>')
+    # the first message after the interval reports the suppressed ones
+    now[0] += 5
+    assert ratelimit.filter(make_record(logging.WARNING, 'b'))
+    now[0] += 5
+    record = make_record(logging.WARNING, 'Exit status %r', 1)
+    assert ratelimit.filter(record)
+    assert record.getMessage() == ('Exit status 1 (suppressed 2 similar '
+                                   'messages)')
+    assert record.suppressed == 2
+    assert ratelimit.filter(make_record(logging.WARNING, 'Exit status %r', 2))
+    assert not hasattr(record, 'iface')
+    # messages not logged again are forgotten after the interval
+    assert (logging.WARNING, 'b') in ratelimit._seen
+    now[0] += 10
+    assert ratelimit.filter(make_record(logging.ERROR, 'c'))
+    assert list(ratelimit._seen) == [(logging.ERROR, 'c')]
+
+
+def test_JsonFormatter():
+    formatter = networkd_dispatcher.JsonFormatter()
+    record = make_record(logging.WARNING, 'Exit status %r from %r', 1, 'a',
+                         iface='eth0', script='a', rc=1, duration=0.5)
+    assert json.loads(formatter.format(record)) == {
+        'time': record.created,
+        'level': 'WARNING',
+        'logger': 'networkd-dispatcher',
+        'message': "Exit status 1 from 'a'",
+        'iface': 'eth0',
+        'script': 'a',
+        'rc': 1,
+        'duration': 0.5,
+    }
+    try:
+        raise ValueError('x')
+    except ValueError:
+        record = make_record(logging.ERROR, 'Error')
+        record.exc_info = sys.exc_info()
+    entry = json.loads(formatter.format(record))
+    assert entry['message'] == 'Error'
+    assert entry['exc'].endswith('ValueError: x')
+
+
+def test_journal_message():
+    assert networkd_dispatcher.journal_message([('MESSAGE', 'a b'),
+                                                ('rc', 1)]) == (
+        b'MESSAGE=a b\nRC=1\n')
+    # values with newlines are sent with their length
+    assert networkd_dispatcher.journal_message([('MESSAGE', 'a\nb')]) == (
+        b'MESSAGE\n' + struct.pack('<Q', 3) + b'a\nb\n')
+    assert [networkd_dispatcher.journal_priority(level) for level in (
+        logging.CRITICAL, logging.ERROR, logging.WARNING, logging.INFO,
+        logging.DEBUG)] == [2, 3, 4, 6, 7]
+
+
+def test_JournalHandler(tmpdir, monkeypatch):
+    path = str(tmpdir.join('socket'))
+    with pytest.raises(OSError):
+        networkd_dispatcher.JournalHandler(path)
+    journal = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    journal.bind(path)
+    handler = networkd_dispatcher.JournalHandler(path)
+    handler.emit(make_record(logging.WARNING, 'Killing script %r', 'a',
+                             iface='eth0', script='a', duration=2.5))
+    assert journal.recv(4096) == (
+        b"MESSAGE=Killing script 'a'\nPRIORITY=4\n"
+        b"SYSLOG_IDENTIFIER=networkd-dispatcher\n"
+        b"LOGGER=networkd-dispatcher\nIFACE=eth0\nSCRIPT=a\n"
+        b"DURATION=2.5\n")
+    # errors are handled by the logging module
+    errors = []
+    monkeypatch.setattr(handler, 'handleError', errors.append)
+    journal.close()
+    record = make_record(logging.INFO, 'a')
+    handler.emit(record)
+    assert errors == [record]
+    handler.close()
+
+
+@patch.object(logging, 'basicConfig')
+def test_setup_logging(mock_basicconfig, tmpdir, monkeypatch, caplog):
+    handler = networkd_dispatcher.setup_logging(logging.INFO)
+    mock_basicconfig.assert_called_with(level=logging.INFO,
+                                        handlers=[handler])
+    assert handler.formatter._fmt == LOG_FORMAT
+    ratelimit, = handler.filters
+    assert ratelimit.interval == networkd_dispatcher.DEFAULT_LOG_RATE_LIMIT
+    handler = networkd_dispatcher.setup_logging(logging.DEBUG, 'json', 0)
+    assert isinstance(handler.formatter, networkd_dispatcher.JsonFormatter)
+    assert handler.filters == []
+    # the journal, or standard error if it cannot be reached
+    path = str(tmpdir.join('socket'))
+    monkeypatch.setattr(networkd_dispatcher.JournalHandler.__init__,
+                        '__defaults__', (path, 'networkd-dispatcher'))
+    caplog.clear()
+    handler = networkd_dispatcher.setup_logging(logging.INFO, 'journal')
+    assert isinstance(handler, logging.StreamHandler)
+    _, _, warn = caplog.record_tuples[0]
+    assert warn.startswith('Unable to connect to the journal; logging to '
+                           'standard error: ')
+    journal = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    journal.bind(path)
+    handler = networkd_dispatcher.setup_logging(logging.INFO, 'journal')
+    assert isinstance(handler, networkd_dispatcher.JournalHandler)
+    handler.close()
+    journal.close()
+
+
 @patch('socket.socket')
 def test_sd_notify(mock_socket, monkeypatch, caplog):
     # no state specified
@@ -300,12 +2371,301 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
                                 lambda: get_networkctl_list_out)
             caplog.set_level(logging.DEBUG)
             self.dp._interface_scan()
-            assert self.dp.ifaces_by_name == Dispatcher_ifaces_by_name
-            assert self.dp.iface_names_by_idx == Dispatcher_iface_names_by_idx
+            assert self.dp.interfaces.by_name == Dispatcher_ifaces_by_name
+            assert ({idx: iface.name for idx, iface
+                     in self.dp.interfaces.by_idx.items()}
+                    == Dispatcher_iface_names_by_idx)
+            _, _, debug = caplog.record_tuples[0]
+            assert debug.startswith('Performed interface scan, adding 3 '
+                                    'interfaces; state: <Dispatcher('
+                                    'script_dir=')
+            # known interfaces are left alone
+            wlan0 = self.dp.interfaces.get('wlan0')
+            wlan0.operational = 'dormant'
+            caplog.clear()
+            self.dp._interface_scan()
+            assert self.dp.interfaces.get('wlan0') is wlan0
+            assert wlan0.operational == 'dormant'
             _, _, debug = caplog.record_tuples[0]
-            assert debug == ('Performed interface scan; state: <Dispatcher({'
-                             '\'script_dir\': \'/etc/networkd-dispatcher:/usr'
-                             '/lib/networkd-dispatcher\'})>')
+            assert debug.startswith('Performed interface scan, adding 0 '
+                                    'interfaces')
+            wlan0.operational = 'routable'
+
+
+        @patch.object(networkd_dispatcher, 'get_networkctl_list')
+        @patch.object(networkd_dispatcher, 'get_dbus_link_list')
+        def test_get_link_list(self, mock_dbus_list, mock_networkctl_list,
+                               monkeypatch, get_networkctl_list_out, caplog):
+            monkeypatch.setattr(self.dp, 'bus', mock.MagicMock())
+            mock_networkctl_list.return_value = get_networkctl_list_out
+            # networkctl backend
+            assert self.dp.get_link_list() == get_networkctl_list_out
+            mock_dbus_list.assert_not_called()
+            # dbus backend
+            monkeypatch.setattr(self.dp, 'backend', 'dbus')
+            mock_dbus_list.return_value = get_networkctl_list_out[:1]
+            assert self.dp.get_link_list() == get_networkctl_list_out[:1]
+            mock_dbus_list.assert_called_with(self.dp.bus)
+            # dbus backend failure falls back to networkctl
+            caplog.clear()
+            mock_dbus_list.return_value = None
+            assert self.dp.get_link_list() == get_networkctl_list_out
+            _, _, warn = caplog.record_tuples[0]
+            assert warn == 'Falling back to networkctl for interface list'
+            # ... unless networkctl is unavailable
+            monkeypatch.setattr(networkd_dispatcher, 'NETWORKCTL', None)
+            assert self.dp.get_link_list() == []
+
+        @patch.object(networkd_dispatcher, 'get_networkctl_status')
+        @patch.object(networkd_dispatcher, 'get_dbus_link_status')
+        def test_get_link_status(self, mock_dbus_status,
+                                 mock_networkctl_status, monkeypatch,
+                                 Dispatcher_ifaces_by_name,
+                                 get_networkctl_status_out,
+                                 get_dbus_link_status_out, caplog):
+            monkeypatch.setattr(self.dp, 'interfaces', InterfaceRegistry(
+                Dispatcher_ifaces_by_name.values()))
+            monkeypatch.setattr(self.dp, 'bus', mock.MagicMock())
+            mock_networkctl_status.return_value = get_networkctl_status_out
+            mock_dbus_status.return_value = get_dbus_link_status_out
+            # networkctl backend
+            assert (self.dp.get_link_status('wlan0') ==
+                    get_networkctl_status_out)
+            mock_networkctl_status.assert_called_with('wlan0')
+            # dbus backend
+            monkeypatch.setattr(self.dp, 'backend', 'dbus')
+            assert (self.dp.get_link_status('wlan0') ==
+                    get_dbus_link_status_out)
+            mock_dbus_status.assert_called_with(self.dp.bus, 2)
+            # dbus backend failure falls back to networkctl
+            caplog.clear()
+            mock_dbus_status.return_value = None
+            assert (self.dp.get_link_status('wlan0') ==
+                    get_networkctl_status_out)
+            _, _, warn = caplog.record_tuples[0]
+            assert warn == ('Falling back to networkctl for interface '
+                            '\'wlan0\' status')
+            # ... unless networkctl is unavailable
+            monkeypatch.setattr(networkd_dispatcher, 'NETWORKCTL', None)
+            assert self.dp.get_link_status('wlan0') == {}
+
+        @patch.object(networkd_dispatcher, 'get_netlink_links')
+        @patch.object(networkd_dispatcher, 'get_networkctl_status')
+        def test_get_link_status_netlink(self, mock_networkctl_status,
+                                         mock_netlink_links, monkeypatch,
+                                         get_networkctl_status_out):
+            monkeypatch.setattr(self.dp, 'netlink_addresses', True)
+            mock_networkctl_status.side_effect = (
+                lambda x: dict(get_networkctl_status_out))
+            mock_netlink_links.return_value = {
+                'wlan0': networkd_dispatcher.NetlinkLink(2, 'wlan0',
+                                                         ['1.1.1.7'])}
+            assert self.dp.get_link_status('wlan0')['Address'] == ['1.1.1.7']
+            assert self.dp.get_link_status('eth0')['Address'] == []
+            # keep the backend addresses if the dump failed
+            mock_netlink_links.return_value = None
+            assert (self.dp.get_link_status('wlan0')['Address'] ==
+                    ['1.1.1.100'])
+
+        @patch.object(networkd_dispatcher, 'get_netlink_links')
+        @patch.object(networkd_dispatcher, 'get_networkctl_statuses')
+        @patch.object(Dispatcher, 'get_link_status')
+        def test_get_link_statuses(self, mock_get_link_status,
+                                   mock_networkctl_statuses,
+                                   mock_netlink_links, monkeypatch, tmp_path):
+            monkeypatch.setattr(networkd_dispatcher, 'NETWORKCTL',
+                                '/usr/bin/networkctl')
+            mock_networkctl_statuses.return_value = {
+                'wlan0': collections.defaultdict(list, {'Type': 'wlan'})}
+            mock_get_link_status.side_effect = lambda name: {'Name': name}
+            dp = Dispatcher(script_cache=False, scan=False, backend='dbus')
+            # one query per interface with other backends
+            assert dp.get_link_statuses(['wlan0', 'eth0']) == {
+                'wlan0': {'Name': 'wlan0'}, 'eth0': {'Name': 'eth0'}}
+            mock_networkctl_statuses.assert_not_called()
+            # a single networkctl call, with addresses read at once
+            dp = Dispatcher(script_cache=False, scan=False,
+                            netlink_addresses=True,
+                            record=str(tmp_path / 'events.jsonl'))
+            mock_netlink_links.return_value = {
+                'eth0': networkd_dispatcher.NetlinkLink(3, 'eth0',
+                                                        ['1.1.1.7'])}
+            assert dp.get_link_statuses(['wlan0', 'eth0']) == {
+                'wlan0': {'Type': 'wlan', 'Address': []},
+                'eth0': {'Address': ['1.1.1.7']}}
+            mock_networkctl_statuses.assert_called_once_with(['wlan0',
+                                                              'eth0'])
+            assert dp.metrics.networkctl['status'].count == 1
+            dp.recorder.close()
+            with open(str(tmp_path / 'events.jsonl')) as fh:
+                assert len(fh.readlines()) == 3
+            # falls back to one query per interface if networkctl failed
+            mock_networkctl_statuses.return_value = None
+            assert dp.get_link_statuses(['eth0']) == {
+                'eth0': {'Name': 'eth0'}}
+
+        @patch.object(Dispatcher, 'get_scripts_list')
+        @patch.object(Dispatcher, 'get_link_statuses')
+        def test_batch(self, mock_get_link_statuses, mock_get_scripts_list,
+                       monkeypatch, child_watches, tmp_path, caplog):
+            monkeypatch.setattr(networkd_dispatcher, 'get_wlan_essid',
+                                lambda x: 'whatever')
+            for name in ('single', 'batch'):
+                (tmp_path / name).mkdir()
+            (tmp_path / 'batch' / networkd_dispatcher.BATCH_MARKER).touch()
+            mock_get_scripts_list.return_value = [
+                str(tmp_path / 'single' / 'a'), str(tmp_path / 'batch' / 'b')]
+            mock_get_link_statuses.side_effect = lambda names: {
+                name: {'Address': ['1.1.1.%d' % i]}
+                for i, name in enumerate(names)}
+            dp = Dispatcher(script_cache=False, scan=False, batch_ms=50)
+            dp.hook_runner = mock.MagicMock()
+            dp.hook_runner.running = dp.hook_runner.backlog = 0
+            dp.state_cache = mock.MagicMock()
+            dp.interfaces = InterfaceRegistry([
+                NetworkctlListState(2, 'wlan0', 'wlan', 'off', 'configured'),
+                NetworkctlListState(3, 'eth0', 'ether', 'off', 'configured')])
+            dp.handle_state('wlan0', operational_state='routable')
+            dp.handle_state('eth0', operational_state='routable')
+            dp.handle_state('eth0', operational_state='routable', force=True)
+            # eth0 leaves the state before the batch is handled
+            dp.handle_state('eth0', operational_state='degraded')
+            assert dp.busy
+            interval, flush, data = child_watches.timeouts[1]
+            assert interval == 50
+            dp.hook_runner.submit.assert_not_called()
+            assert flush(*data) is False
+            mock_get_link_statuses.assert_called_once_with(['wlan0', 'eth0'])
+            calls = dp.hook_runner.submit.call_args_list
+            assert [c[0][:2] for c in calls] == [
+                ('wlan0', [[str(tmp_path / 'single' / 'a')]]),
+                ('eth0', [[str(tmp_path / 'single' / 'a')]]),
+                ('batch:routable', [[str(tmp_path / 'batch' / 'b')]])]
+            assert calls[1][0][2]['ADDR'] == '1.1.1.1'
+            assert calls[1][0][2]['OperationalState'] == 'routable'
+            assert json.loads(calls[1][0][2]['json'])['State'] == (
+                'routable (configured)')
+            env = calls[2][0][2]
+            assert env.maps[-1] is dp.base_env
+            assert env['STATE'] == 'routable'
+            assert env['IFACES'] == 'wlan0 eth0'
+            batch_data = json.loads(env['json'])
+            assert [d['InterfaceName'] for d in batch_data] == ['wlan0',
+                                                                'eth0']
+            assert batch_data[0]['ESSID'] == 'whatever'
+            assert batch_data[1]['OperationalState'] == 'routable'
+            # the states are recorded once all scripts of the batch ran
+            for call in calls:
+                dp.state_cache.record.assert_not_called()
+                call[0][3]()
+            assert dp.state_cache.record.call_args_list == [
+                mock.call(NetworkctlListState(2, 'wlan0', 'wlan', 'routable',
+                                              'configured'), 'operational'),
+                mock.call(NetworkctlListState(3, 'eth0', 'ether', 'routable',
+                                              'configured'), 'operational')]
+            interval, flush, data = child_watches.timeouts[2]
+            assert flush(*data) is False
+            assert not dp.busy
+            env = dp.hook_runner.submit.call_args_list[-2][0][2]
+            assert env['OperationalState'] == 'degraded'
+            metrics = dp.get_state_metrics()
+            assert metrics['batches_total'][2] == 2
+            assert metrics['batched_interfaces_total'][2] == 3
+            # errors are logged
+            mock_get_link_statuses.side_effect = OSError('failed')
+            dp.handle_state('eth0', operational_state='off')
+            caplog.clear()
+            assert dp._flush_batch('off') is False
+            _, _, err = caplog.record_tuples[0]
+            assert err == ('Error handling batch of interfaces entering '
+                           'state off')
+
+        @patch.object(Dispatcher, 'get_link_statuses')
+        def test_batch_transition(self, mock_get_link_statuses, script_path,
+                                  child_watches, tmp_path):
+            etc, usr = script_path.split(':')
+            single = [make_script(etc + '/off->routable.d', '10-b'),
+                      make_script(etc + '/routable.d', '20-a')]
+            batch = [make_script(usr + '/routable.d', '30-c'),
+                     make_script(usr + '/off->routable.d', '40-d')]
+            for dirname in (usr + '/routable.d', usr + '/off->routable.d'):
+                make_script(dirname, networkd_dispatcher.BATCH_MARKER)
+            mock_get_link_statuses.side_effect = lambda names: {
+                name: {} for name in names}
+            dp = Dispatcher(script_dir=script_path, script_cache=False,
+                            scan=False, batch_ms=50,
+                            plugin_dir=str(tmp_path / 'missing'))
+            dp.hook_runner = mock.MagicMock()
+            dp.plugins = mock.MagicMock()
+            dp.plugins.busy = False
+            dp.interfaces = InterfaceRegistry([
+                NetworkctlListState(3, 'eth0', 'ether', 'off', 'configured'),
+                NetworkctlListState(4, 'eth1', 'ether', 'degraded',
+                                    'configured')])
+            dp.handle_state('eth0', operational_state='routable')
+            dp.handle_state('eth1', operational_state='routable')
+            (_, flush, data), = child_watches.timeouts.values()
+            assert flush(*data) is False
+            calls = dp.hook_runner.submit.call_args_list
+            assert [c[0][:2] for c in calls] == [
+                ('eth0', [[single[0]], [single[1]]]),
+                ('eth1', [[single[1]]]),
+                ('batch:routable', [[batch[0]]]),
+                ('batch:routable', [[batch[1]]])]
+            assert [c[0][2].get('PREVIOUS_STATE') for c in calls] == [
+                'off', 'degraded', None, None]
+            assert [c[0][2]['IFACES'] for c in calls[2:]] == ['eth0 eth1',
+                                                              'eth0']
+            # plugins get the data of each interface
+            events = [c[0][0] for c in dp.plugins.submit.call_args_list]
+            assert [event[:4] for event in events] == [
+                ('eth0', 'routable', 'operational', 'off'),
+                ('eth1', 'routable', 'operational', 'degraded')]
+            assert json.loads(events[0].data)['InterfaceName'] == 'eth0'
+
+        @patch.object(Dispatcher, 'get_scripts_list')
+        @patch.object(Dispatcher, 'get_link_statuses')
+        def test_batch_match(self, mock_get_link_statuses,
+                             mock_get_scripts_list, monkeypatch,
+                             child_watches, tmp_path):
+            for name in ('single', 'batch'):
+                (tmp_path / name).mkdir()
+            (tmp_path / 'batch' / networkd_dispatcher.BATCH_MARKER).touch()
+            for name, match in (
+                    ('single', {'iface': 'wlan*'}),
+                    ('batch', {'scripts': {'b': {'iface': 'eth0'},
+                                           'c': {'type': 'loopback'}}})):
+                with open(str(tmp_path / name / networkd_dispatcher.
+                              MATCH_FILE), 'w') as fh:
+                    json.dump(match, fh)
+            single = str(tmp_path / 'single' / 'a')
+            batch = [str(tmp_path / 'batch' / name) for name in 'bcd']
+            mock_get_scripts_list.return_value = [single] + batch
+            mock_get_link_statuses.side_effect = lambda names: {
+                name: {} for name in names}
+            dp = Dispatcher(script_cache=False, scan=False, batch_ms=50)
+            dp.hook_runner = mock.MagicMock()
+            dp.interfaces = InterfaceRegistry([
+                NetworkctlListState(3, 'eth0', 'ether', 'off', 'configured'),
+                NetworkctlListState(4, 'eth1', 'ether', 'off', 'configured')])
+            dp.handle_state('eth0', operational_state='routable')
+            dp.handle_state('eth1', operational_state='routable')
+            (_, flush, data), = child_watches.timeouts.values()
+            assert not dp.metrics.scripts
+            assert flush(*data) is False
+            calls = dp.hook_runner.submit.call_args_list
+            assert [(c[0][1], c[0][2]['IFACES']) for c in calls] == [
+                ([[batch[0]]], 'eth0'), ([[batch[2]]], 'eth0 eth1')]
+            # single scripts are counted per interface, batch scripts once
+            assert dp.metrics.scripts[single].filtered == 2
+            assert dp.metrics.scripts[batch[1]].filtered == 1
+            assert batch[0] not in dp.metrics.scripts
+
+        @patch('dbus.SystemBus')
+        def test__get_bus(self, mock_dbus_SystemBus, monkeypatch):
+            monkeypatch.setattr(self.dp, 'bus', None)
+            assert self.dp._get_bus() is mock_dbus_SystemBus.return_value
+            mock_dbus_SystemBus.assert_called_with()
 
         @patch('dbus.SystemBus')
         @patch('dbus.bus.BusConnection')
@@ -313,6 +2673,142 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
             mock_dbus_SystemBus.return_value = mock.MagicMock()
             self.dp.register(bus=None)
             mock_dbus_SystemBus.assert_called_with()
+            bus = mock_dbus_SystemBus.return_value
+            bus.add_message_filter.assert_called_with(self.dp._filter_message)
+            rule, = bus.add_match_string.call_args[0]
+            assert "sender='org.freedesktop.network1'" in rule
+            assert "arg0='org.freedesktop.network1.Link'" in rule
+            assert "path_namespace='/org/freedesktop/network1/link'" in rule
+            bus.watch_name_owner.assert_called_with(
+                'org.freedesktop.network1', self.dp._on_networkd_owner)
+
+        @patch.object(networkd_dispatcher.Dispatcher, '_schedule_reconcile')
+        def test__on_networkd_owner(self, mock_schedule, monkeypatch):
+            monkeypatch.setattr(self.dp, '_networkd_owner', None)
+            # the owner at registration
+            self.dp._on_networkd_owner(':1.5')
+            mock_schedule.assert_not_called()
+            self.dp._on_networkd_owner('')
+            mock_schedule.assert_not_called()
+            # systemd-networkd restarted
+            self.dp._on_networkd_owner(':1.9')
+            mock_schedule.assert_called_once_with(1)
+            self.dp._on_networkd_owner(':1.9')
+            mock_schedule.assert_called_once_with(1)
+
+        @patch.object(networkd_dispatcher.Dispatcher, 'handle_state')
+        def test_reconcile(self, mock_handle_state, monkeypatch, caplog):
+            eth0 = NetworkctlListState(2, 'eth0', 'ether', 'routable',
+                                       'configured')
+            wlan0 = NetworkctlListState(3, 'wlan0', 'wlan', 'dormant',
+                                        'configured')
+            monkeypatch.setattr(self.dp, 'metrics',
+                                networkd_dispatcher.Metrics())
+            monkeypatch.setattr(self.dp, 'interfaces',
+                                InterfaceRegistry([eth0, wlan0]))
+            links = [eth0, wlan0]
+            monkeypatch.setattr(self.dp, 'get_link_list', lambda: links)
+            caplog.set_level(logging.DEBUG)
+            assert self.dp.reconcile() == 0
+            mock_handle_state.assert_not_called()
+            assert (caplog.record_tuples[-1][2] ==
+                    'Reconciliation found no missed changes')
+            # missed state changes, interfaces added and removed
+            links[:] = [
+                NetworkctlListState(3, 'wlan0', 'wlan', 'routable',
+                                    'configuring'),
+                NetworkctlListState(4, 'wlan1', 'wlan', 'off', 'unmanaged')]
+            assert self.dp.reconcile() == 4
+            mock_handle_state.assert_has_calls([
+                mock.call('eth0', administrative_state='linger',
+                          operational_state=None),
+                mock.call('wlan0', administrative_state='configuring',
+                          operational_state='routable'),
+                mock.call('wlan1', administrative_state='unmanaged',
+                          operational_state='off', force=True)])
+            assert mock_handle_state.call_count == 3
+            assert sorted(self.dp.interfaces.by_idx) == [3, 4]
+            assert caplog.record_tuples[-1][2] == (
+                'Reconciliation found 4 missed changes: 1 administrative, '
+                '1 operational, 1 new_interface, 1 removed_interface')
+            assert self.dp.metrics.reconciles == 2
+            assert self.dp.metrics.drift == {
+                'administrative': 1, 'operational': 1, 'new_interface': 1,
+                'removed_interface': 1}
+            # failed listings are not taken as interfaces being removed
+            links[:] = []
+            assert self.dp.reconcile() == 0
+            assert len(self.dp.interfaces) == 2
+            assert (caplog.record_tuples[-1][2] ==
+                    'Skipping reconciliation with an empty interface list')
+
+        @patch.object(networkd_dispatcher.random, 'uniform', lambda x, y: y)
+        @patch.object(networkd_dispatcher.Dispatcher, 'reconcile')
+        def test_reconcile_schedule(self, mock_reconcile, monkeypatch,
+                                    child_watches, caplog):
+            dp = Dispatcher(scan=False, reconcile_interval=60)
+            interval, function, data = child_watches.timeouts[1]
+            assert interval == 66000
+            # postponed until events are handled
+            assert function(*data) is False
+            mock_reconcile.assert_not_called()
+            assert child_watches.timeouts[2][0] == 1100
+            dp.pending_events = None
+            assert function(*data) is False
+            mock_reconcile.assert_called_once_with()
+            assert child_watches.timeouts[3][0] == 66000
+            # errors are logged, and scheduled reconciliations replaced
+            mock_reconcile.side_effect = ValueError
+            dp._schedule_reconcile(1)
+            assert child_watches.removed == [3]
+            assert function(*data) is False
+            _, _, ex = caplog.record_tuples[-1]
+            assert ex == 'Error reconciling interface states'
+            assert len(child_watches.timeouts) == 5
+            dp.reconcile_interval = 0
+            assert function(*data) is False
+            assert len(child_watches.timeouts) == 5
+
+        @patch.object(networkd_dispatcher.Dispatcher, '_receive_signal')
+        def test__filter_message(self, mock_receive_signal):
+            dp = Dispatcher()
+            not_yet_handled = dbus.lowlevel.HANDLER_RESULT_NOT_YET_HANDLED
+
+            def message(path, member='PropertiesChanged',
+                        interface='org.freedesktop.DBus.Properties',
+                        typ=dbus.lowlevel.MESSAGE_TYPE_SIGNAL):
+                msg = mock.MagicMock()
+                msg.get_type.return_value = typ
+                msg.get_member.return_value = member
+                msg.get_interface.return_value = interface
+                msg.get_path.return_value = path
+                msg.get_args_list.return_value = [
+                    'org.freedesktop.network1.Link',
+                    {'OperationalState': 'routable'}, []]
+                return msg
+
+            # other messages are left alone and not counted
+            for msg in (message('/', typ=dbus.lowlevel.
+                                MESSAGE_TYPE_METHOD_RETURN),
+                        message('/', member='NameOwnerChanged'),
+                        message('/', interface='org.freedesktop.DBus')):
+                assert dp._filter_message(None, msg) == not_yet_handled
+                assert not msg.get_args_list.called
+            assert dp.metrics.signals_received == 0
+            # signals of other objects are dropped before unmarshalling
+            msg = message('/org/freedesktop/network1')
+            assert dp._filter_message(None, msg) == not_yet_handled
+            assert not msg.get_args_list.called
+            assert not mock_receive_signal.called
+            assert dp.metrics.signals_received == 1
+            assert dp.metrics.signals_ignored['unexpected_path'] == 1
+            # Link signals are handled
+            msg = message('/org/freedesktop/network1/link/_33')
+            assert dp._filter_message(None, msg) == not_yet_handled
+            mock_receive_signal.assert_called_once_with(
+                'org.freedesktop.network1.Link',
+                {'OperationalState': 'routable'}, None,
+                '/org/freedesktop/network1/link/_33')
 
         @patch('networkd_dispatcher.Dispatcher.handle_state')
         def test_trigger_all(self, mock_hs, monkeypatch, caplog):
@@ -321,8 +2817,8 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
                                         type='wlan',
                                         operational='routable',
                                         administrative='configured')
-            monkeypatch.setattr(('networkd_dispatcher.Dispatcher'
-                                 '.ifaces_by_name'), {'wlan0': iface})
+            monkeypatch.setattr(self.dp, 'interfaces',
+                                InterfaceRegistry([iface]))
             mock_hs.return_value = None
             self.dp.trigger_all()
             mock_hs.assert_called_with('wlan0',
@@ -330,19 +2826,28 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
                                        operational_state='routable',
                                        force=True)
             # invalid iface
-            monkeypatch.setattr(('networkd_dispatcher.Dispatcher'
-                                 '.ifaces_by_name'), {'eth0': 1})
+            monkeypatch.setattr(self.dp, 'interfaces', [1])
             caplog.clear()
             caplog.set_level(logging.WARNING)
             self.dp.trigger_all()
             _, _, ex = caplog.record_tuples[0]
             assert ex == 'Error handling initial for interface 1'
+            # unchanged states are skipped
+            state_cache = mock.MagicMock()
+            state_cache.changed.side_effect = (
+                lambda iface, state_type: state_type == 'operational')
+            monkeypatch.setattr(self.dp, 'state_cache', state_cache)
+            monkeypatch.setattr(self.dp, 'interfaces',
+                                InterfaceRegistry([iface]))
+            self.dp.trigger_all()
+            mock_hs.assert_called_with('wlan0', administrative_state=None,
+                                       operational_state='routable',
+                                       force=True)
 
         @patch('networkd_dispatcher.Dispatcher.run_hooks_for_state')
         def test__handle_one_state(self, mock_run_hooks_for_state,
                                    monkeypatch, caplog):
-            monkeypatch.setattr(('networkd_dispatcher.Dispatcher'
-                                 '.ifaces_by_name'), {})
+            monkeypatch.setattr(self.dp, 'interfaces', InterfaceRegistry())
             # None state
             assert self.dp._handle_one_state(self, None, None, None) is None
             # None for prior iface
@@ -359,8 +2864,8 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
                                         type='wlan',
                                         operational='routable',
                                         administrative='configured')
-            monkeypatch.setattr(('networkd_dispatcher.Dispatcher'
-                                 '.ifaces_by_name'), {'wlan0': iface})
+            monkeypatch.setattr(self.dp, 'interfaces',
+                                InterfaceRegistry([iface]))
             assert (self.dp._handle_one_state('wlan0', 'routable',
                                               'operational', force=False)
                     is None)
@@ -373,7 +2878,9 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
             assert (self.dp._handle_one_state('wlan0', 'routable',
                                               'operational', force=True)
                     is None)
-            mock_run_hooks_for_state.assert_called_with(iface, 'routable')
+            mock_run_hooks_for_state.assert_called_with(iface, 'routable',
+                                                        'operational',
+                                                        'routable')
             assert len(caplog.record_tuples) == 0
             # New iface state
             caplog.clear()
@@ -386,9 +2893,19 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
                                             type='wlan',
                                             operational='dormant',
                                             administrative='configured')
-            mock_run_hooks_for_state.assert_called_with(new_iface, 'dormant')
-            assert (self.dp.ifaces_by_name[new_iface.name].operational
-                    == 'dormant')
+            mock_run_hooks_for_state.assert_called_with(new_iface, 'dormant',
+                                                        'operational',
+                                                        'routable')
+            # updated in place
+            assert self.dp.interfaces.get('wlan0') == new_iface
+            assert (mock_run_hooks_for_state.call_args[0][0] is
+                    self.dp.interfaces.get('wlan0'))
+            # only recorded in the state file once scripts ran
+            state_cache = mock.MagicMock()
+            monkeypatch.setattr(self.dp, 'state_cache', state_cache)
+            self.dp._handle_one_state('wlan0', 'degraded', 'operational')
+            state_cache.record.assert_not_called()
+            monkeypatch.setattr(self.dp, 'state_cache', None)
             # Exceptions
             caplog.clear()
             mock_run_hooks_for_state.side_effect = Exception()
@@ -410,7 +2927,8 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
             mock__handle_one_state.assert_has_calls(calls, any_order=False)
 
         @patch.object(networkd_dispatcher, 'scripts_in_path')
-        def test_get_scripts_list(self, mock_scripts_in_path):
+        def test_get_scripts_list(self, mock_scripts_in_path, monkeypatch):
+            monkeypatch.setattr(self.dp, 'script_index', None)
             for basedir in ['/etc/networkd-dispatcher',
                             '/usr/lib/networkd-dispatcher']:
                 for subdir in ['dormant', 'no-carrier', 'off', 'routable']:
@@ -419,6 +2937,34 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
                     assert (self.dp.get_scripts_list(state=subdir)
                             == expected)
 
+        def test_get_scripts_list_index(self, monkeypatch):
+            index = mock.MagicMock()
+            index.get.side_effect = lambda subdir: [
+                '/etc/networkd-dispatcher/%s/%s-x' % (
+                    subdir, '10' if subdir == 'off.d' else '20')]
+            index.routes.return_value = {
+                ('routable', 'off'): 'routable->off.d',
+                ('off', 'off'): 'off->off.d'}
+            monkeypatch.setattr(self.dp, 'script_index', index)
+            for prior_state in (None, 'degraded', 'off'):
+                assert (self.dp.get_scripts_list('off', prior_state) ==
+                        ['/etc/networkd-dispatcher/off.d/10-x'])
+                index.get.assert_called_with('off.d')
+            assert self.dp.get_scripts_list('off', 'routable') == [
+                '/etc/networkd-dispatcher/off.d/10-x',
+                '/etc/networkd-dispatcher/routable->off.d/20-x']
+
+        def test_get_scripts_list_transition(self, script_path):
+            etc, usr = script_path.split(':')
+            scripts = [make_script(usr + '/off.d', '10-off'),
+                       make_script(etc + '/routable->off.d', '20-routable')]
+            dp = Dispatcher(script_dir=script_path, script_cache=False,
+                            scan=False)
+            assert dp.get_scripts_list('off') == scripts[:1]
+            assert dp.get_scripts_list('off', 'off') == scripts[:1]
+            assert dp.get_scripts_list('off', 'degraded') == scripts[:1]
+            assert dp.get_scripts_list('off', 'routable') == scripts
+
         @patch('subprocess.Popen')
         def test_run_hooks_for_state(self, mock_subprocess, monkeypatch,
                                      get_interface_data_out,
@@ -428,6 +2974,7 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
                      'IP6_ADDRS': ('feed::82c9:7bbf:ae39:8ff0 '
                                    'deeb::7bb8:f2c9:8ff0:ae39'),
                      'IFACE': 'wlan0', 'STATE': 'routable',
+                     'PREVIOUS_STATE': 'degraded',
                      'AdministrativeState': 'configured',
                      'OperationalState': 'routable',
                      'json': ('{"AdministrativeState": "configured", '
@@ -446,58 +2993,307 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
             ipv6 = ['feed::82c9:7bbf:ae39:8ff0', 'deeb::7bb8:f2c9:8ff0:ae39']
             addrs = networkd_dispatcher.AddressList(ipv4, ipv6)
             monkeypatch.setattr('networkd_dispatcher.get_interface_data',
-                                lambda x: get_interface_data_out)
+                                lambda *a: get_interface_data_out)
             monkeypatch.setattr('networkd_dispatcher.Dispatcher.'
                                 'get_scripts_list',
-                                lambda x, y: (['/etc/networkd-dispatcher/'
-                                              'routable.d/10openvpn']))
+                                lambda x, y, z: (['/etc/networkd-dispatcher/'
+                                                 'routable.d/10openvpn']))
             monkeypatch.setattr('networkd_dispatcher.parse_address_strings',
                                 lambda x: addrs)
-            old_environ = os.environ
-            os.environ.clear()
-            self.dp.run_hooks_for_state(self.dp.ifaces_by_name['wlan0'],
-                                        'routable')
+            monkeypatch.setattr(self.dp, 'base_env', {})
+            self.dp.run_hooks_for_state(self.dp.interfaces.get('wlan0'),
+                                        'routable', 'operational', 'degraded')
             mock_subprocess.assert_called_with(('/etc/networkd-dispatcher/'
                                                 'routable.d/10openvpn'),
                                                env=e_env)
             # bad exit status from script
             mock_subprocess.wait.return_value = -1
-            os.environ = old_environ
             caplog.clear()
-            self.dp.run_hooks_for_state(self.dp.ifaces_by_name['wlan0'],
-                                        'routable')
+            self.dp.run_hooks_for_state(self.dp.interfaces.get('wlan0'),
+                                        'routable', 'operational')
             caplog.set_level(logging.WARNING)
             _, _, warn = caplog.record_tuples[0]
             assert not warn.startswith('Exist status')
+            # only the variables set for scripts are logged
+            caplog.clear()
+            caplog.set_level(logging.DEBUG)
+            self.dp.run_hooks_for_state(self.dp.interfaces.get('wlan0'),
+                                        'routable', 'operational')
+            record = caplog.records[0]
+            assert record.getMessage().startswith(
+                'Running triggers for interface Interface(idx=2, ')
+            assert record.args[2]['IFACE'] == 'wlan0'
+            assert not set(record.args[2]) & set(os.environ)
+            assert (record.iface, record.state) == ('wlan0', 'routable')
+            # the state is recorded once the scripts returned
+            state_cache = mock.MagicMock()
+            monkeypatch.setattr(self.dp, 'state_cache', state_cache)
+            self.dp.run_hooks_for_state(self.dp.interfaces.get('wlan0'),
+                                        'routable', 'operational')
+            state_cache.record.assert_called_once_with(
+                NetworkctlListState(*self.dp.interfaces.get('wlan0')),
+                'operational')
+            monkeypatch.setattr(self.dp, 'state_cache', None)
             # no scripts
             monkeypatch.setattr(Dispatcher, 'get_scripts_list',
-                                lambda x, y: None)
+                                lambda x, y, z: None)
             caplog.clear()
             caplog.set_level(logging.DEBUG)
-            assert self.dp.run_hooks_for_state(self.dp.ifaces_by_name['wlan0'],
-                                               'routable') is None
+            assert self.dp.run_hooks_for_state(
+                self.dp.interfaces.get('wlan0'), 'routable',
+                'operational') is None
             _, _, debug = caplog.record_tuples[0]
             assert debug == ('Ignoring notification for interface '
-                             'NetworkctlListState(idx=2, name=\'wlan0\', '
+                             'Interface(idx=2, name=\'wlan0\', '
                              'type=\'wlan\', operational=\'routable\', '
                              'administrative=\'configured\') entering state '
                              '\'routable\': no triggers')
 
+        @patch('subprocess.Popen')
+        def test_run_hooks_for_state_timeout(self, mock_popen, monkeypatch,
+                                             get_interface_data_out, caplog):
+            monkeypatch.setattr('networkd_dispatcher.get_interface_data',
+                                lambda *a: get_interface_data_out)
+            monkeypatch.setattr(Dispatcher, 'get_scripts_list',
+                                lambda x, y, z: ['/etc/networkd-dispatcher/'
+                                                 'routable.d/10openvpn'])
+            monkeypatch.setattr(self.dp, 'limits',
+                                networkd_dispatcher.LimitsCache(5))
+            monkeypatch.setattr(self.dp, 'metrics',
+                                networkd_dispatcher.Metrics())
+            proc = mock_popen.return_value
+            proc.wait.side_effect = [subprocess.TimeoutExpired('x', 5), -9]
+            caplog.clear()
+            self.dp.run_hooks_for_state(self.dp.interfaces.get('wlan0'),
+                                        'routable', 'operational')
+            proc.kill.assert_called_with()
+            _, _, warn = caplog.record_tuples[0]
+            assert warn == ('Killing script \'/etc/networkd-dispatcher/'
+                            'routable.d/10openvpn\' after timeout of 5 '
+                            'seconds')
+            stats = self.dp.metrics.scripts['/etc/networkd-dispatcher/'
+                                            'routable.d/10openvpn']
+            assert stats.timeouts == 1
+
+        def test_run_hooks_for_state_runner(self, monkeypatch,
+                                            get_interface_data_out):
+            runner = mock.MagicMock()
+            monkeypatch.setattr(self.dp, 'hook_runner', runner)
+            monkeypatch.setattr('networkd_dispatcher.get_interface_data',
+                                lambda *a: get_interface_data_out)
+            monkeypatch.setattr(Dispatcher, 'get_scripts_list',
+                                lambda x, y, z: ['/nonexistent/routable.d/a',
+                                                 '/nonexistent/routable.d/b'])
+            self.dp.run_hooks_for_state(self.dp.interfaces.get('wlan0'),
+                                        'routable', 'operational')
+            key, groups, env, done = runner.submit.call_args[0]
+            assert key == 'wlan0'
+            assert groups == [['/nonexistent/routable.d/a'],
+                              ['/nonexistent/routable.d/b']]
+            assert env['IFACE'] == 'wlan0'
+            assert done is None
+            # the state is recorded once the scripts ran
+            state_cache = mock.MagicMock()
+            monkeypatch.setattr(self.dp, 'state_cache', state_cache)
+            wlan0 = self.dp.interfaces.get('wlan0')
+            self.dp.run_hooks_for_state(wlan0, 'routable', 'operational')
+            done = runner.submit.call_args[0][3]
+            state_cache.record.assert_not_called()
+            monkeypatch.setattr(wlan0, 'operational', 'off')
+            done()
+            state_cache.record.assert_called_once_with(
+                NetworkctlListState(*wlan0)._replace(operational='routable'),
+                'operational')
+
+        def test_run_hooks_for_state_dry_run(self, monkeypatch, caplog,
+                                             get_interface_data_out):
+            runner = mock.MagicMock()
+            monkeypatch.setattr(self.dp, 'hook_runner', runner)
+            monkeypatch.setattr(self.dp, 'dry_run', True)
+            monkeypatch.setattr('networkd_dispatcher.get_interface_data',
+                                lambda *a: get_interface_data_out)
+            monkeypatch.setattr(Dispatcher, 'get_scripts_list',
+                                lambda x, y, z: ['/nonexistent/routable.d/a'])
+            caplog.clear()
+            caplog.set_level(logging.INFO)
+            self.dp.run_hooks_for_state(self.dp.interfaces.get('wlan0'),
+                                        'routable', 'operational')
+            runner.submit.assert_not_called()
+            _, _, info = caplog.record_tuples[-1]
+            assert info == ("Not invoking '/nonexistent/routable.d/a' for "
+                            "interface wlan0 (dry run)")
+
+        def test_run_hooks_for_state_plugins(self, monkeypatch, caplog,
+                                             tmp_path, plugin_owners):
+            plugin_dir = str(tmp_path)
+            write_plugin(plugin_dir, 'a.py', PLUGIN_RECORDER % (
+                '"a"', 'routable', 'off'))
+            runner = mock.MagicMock()
+            monkeypatch.setattr(self.dp, 'hook_runner', runner)
+            monkeypatch.setattr(self.dp, 'plugins',
+                                networkd_dispatcher.PluginHost(plugin_dir))
+            monkeypatch.setattr(self.dp, 'get_script_env',
+                                lambda iface: {'IFACE': iface.name,
+                                               'ESSID': 'home',
+                                               'json': '{"ESSID": "home"}'})
+            monkeypatch.setattr(Dispatcher, 'get_scripts_list',
+                                lambda x, y, z: [])
+            wlan0 = self.dp.interfaces.get('wlan0')
+            # plugins run without any scripts
+            self.dp.run_hooks_for_state(wlan0, 'routable', 'operational',
+                                        'degraded')
+            self.dp.run_hooks_for_state(wlan0, 'dormant', 'operational')
+            self.dp.plugins.join()
+            assert not self.dp.plugins.busy
+            runner.submit.assert_not_called()
+            with open(os.path.join(plugin_dir, 'events')) as fh:
+                assert [json.loads(line) for line in fh] == [
+                    ['a', 'wlan0', 'routable', 'degraded', 'home']]
+            assert self.dp.get_state_metrics()[
+                'plugin_events_dropped_total'][2] == 0
+            # dry run
+            monkeypatch.setattr(self.dp, 'dry_run', True)
+            caplog.clear()
+            caplog.set_level(logging.INFO)
+            self.dp.run_hooks_for_state(wlan0, 'off', 'operational')
+            _, _, info = caplog.record_tuples[-1]
+            assert info == 'Not invoking plugins for interface wlan0 (dry run)'
+            self.dp.plugins.join()
+            with open(os.path.join(plugin_dir, 'events')) as fh:
+                assert len(fh.readlines()) == 1
+
+        def test_run_hooks_for_state_events(self, monkeypatch, tmp_path,
+                                            io_watches, caplog):
+            dp = Dispatcher(script_cache=False, scan=False,
+                            event_socket=str(tmp_path / 'missing' / 'sock'))
+            assert dp.event_server is None
+            _, _, err = caplog.record_tuples[-1]
+            assert err.startswith('Unable to listen on event socket ')
+            path = str(tmp_path / 'events.sock')
+            dp = Dispatcher(script_cache=False, scan=False, event_socket=path)
+            dp.interfaces = self.dp.interfaces
+            monkeypatch.setattr(Dispatcher, 'get_scripts_list',
+                                lambda x, y, z: [])
+            monkeypatch.setattr(dp, 'get_script_env',
+                                lambda iface: {'IFACE': iface.name,
+                                               'ESSID': 'home',
+                                               'json': '{"ESSID": "home"}'})
+            wlan0 = dp.interfaces.get('wlan0')
+            # without subscribers, no data is collected
+            caplog.clear()
+            caplog.set_level(logging.DEBUG)
+            dp.run_hooks_for_state(wlan0, 'routable', 'operational')
+            _, _, debug = caplog.record_tuples[-1]
+            assert debug.endswith('no triggers')
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.settimeout(5)
+            client.connect(path)
+            fire(io_watches, dp.event_server._source)
+            dp.run_hooks_for_state(wlan0, 'routable', 'operational',
+                                   'degraded')
+            assert json.loads(client.makefile('rb').readline().decode()) == {
+                'iface': 'wlan0', 'state': 'routable',
+                'state_type': 'operational', 'prior_state': 'degraded',
+                'data': {'ESSID': 'home'}}
+            state = dp.get_state_metrics()
+            assert state['event_subscribers'][2] == 1
+            assert state['events_published_total'][2] == 1
+            assert state['events_dropped_total'][2] == 0
+            dp.event_server.close()
+            client.close()
+
+        def test_run_hooks_for_state_match(self, monkeypatch, caplog,
+                                           tmp_path):
+            runner = mock.MagicMock()
+            monkeypatch.setattr(self.dp, 'hook_runner', runner)
+            monkeypatch.setattr(self.dp, 'matches',
+                                networkd_dispatcher.MatchCache())
+            monkeypatch.setattr(self.dp, 'get_script_env',
+                                lambda iface: {'IFACE': iface.name,
+                                               'ESSID': 'work'})
+            scripts = [str(tmp_path / name) for name in ('a', 'b', 'c')]
+            monkeypatch.setattr(Dispatcher, 'get_scripts_list',
+                                lambda x, y, z: scripts)
+            with open(str(tmp_path / networkd_dispatcher.MATCH_FILE),
+                      'w') as fh:
+                json.dump({'iface': 'wlan*', 'scripts': {
+                    'b': {'iface': 'eth*'},
+                    'c': {'essid': 'home*'}}}, fh)
+            wlan0 = self.dp.interfaces.get('wlan0')
+            caplog.clear()
+            caplog.set_level(logging.DEBUG)
+            self.dp.run_hooks_for_state(wlan0, 'routable', 'operational')
+            _, groups, env, _ = runner.submit.call_args[0]
+            assert groups == [[scripts[0]]]
+            assert env['STATE'] == 'routable'
+            assert ('networkd-dispatcher', logging.DEBUG,
+                    'Not invoking %r for interface wlan0: excluded by its '
+                    'match filters' % scripts[1]) in caplog.record_tuples
+            assert self.dp.metrics.scripts[scripts[1]].filtered == 1
+            assert self.dp.metrics.scripts[scripts[2]].filtered == 1
+            # nothing runs if the ESSID excludes the remaining scripts
+            runner.reset_mock()
+            monkeypatch.setattr(Dispatcher, 'get_scripts_list',
+                                lambda x, y, z: scripts[2:])
+            self.dp.run_hooks_for_state(wlan0, 'routable', 'operational')
+            runner.submit.assert_not_called()
+            assert self.dp.metrics.scripts[scripts[2]].filtered == 2
+
+        @patch.object(networkd_dispatcher, 'get_networkctl_status')
+        @patch.object(networkd_dispatcher, 'get_networkctl_list')
+        def test_record(self, mock_networkctl_list, mock_networkctl_status,
+                        tmp_path, get_networkctl_list_out,
+                        get_networkctl_status_out):
+            mock_networkctl_list.return_value = get_networkctl_list_out
+            mock_networkctl_status.return_value = get_networkctl_status_out
+            path = str(tmp_path / 'events.jsonl')
+            dp = Dispatcher(script_cache=False, record=path)
+            dp._receive_signal('org.freedesktop.network1.Link',
+                               {'CarrierState': 'carrier'}, None,
+                               '/org/freedesktop/network1/link/_32')
+            dp.get_link_status('wlan0')
+            dp.recorder.close()
+            # the recording answers the same queries when replayed
+            replay = networkd_dispatcher.EventReplay(path)
+            assert [record['kind'] for record in replay.records] == [
+                'start', 'list', 'signal', 'status']
+            assert replay.records[2]['data'] == {'CarrierState': 'carrier'}
+            dp = Dispatcher(script_cache=False, scan=False)
+            dp.replay = replay
+            replay._load_answers()
+            assert dp.get_link_list() == get_networkctl_list_out
+            replay._position += 1
+            replay._load_answers()
+            assert dp.get_link_status('wlan0') == get_networkctl_status_out
+            assert mock_networkctl_list.call_count == 1
+            assert mock_networkctl_status.call_count == 1
+
+        def test_busy(self):
+            dp = Dispatcher(script_cache=False, scan=False)
+            assert not dp.busy
+            dp.events.append((1, {}))
+            assert dp.busy
+            dp.events.clear()
+            dp._coalescing[1] = (1, {})
+            assert dp.busy
+            dp._coalescing.clear()
+            dp.hook_runner = networkd_dispatcher.HookRunner()
+            assert not dp.busy
+            dp.hook_runner.running = 1
+            assert dp.busy
+            dp.hook_runner.running = 0
+            dp.plugins = mock.MagicMock()
+            dp.plugins.busy = True
+            assert dp.busy
+
         @patch.object(networkd_dispatcher.Dispatcher, 'handle_state')
         @patch.object(networkd_dispatcher.Dispatcher, '_interface_scan')
         def test__receive_signal(self, mock_interface_scan, mock_handle_state,
                                  caplog):
-            self.dp.ifaces_by_name = {'lo':
-                                      NetworkctlListState(idx=1,
-                                                          name='lo',
-                                                          type='loopback',
-                                                          operational='carrier',
-                                                          administrative='unmanaged'),
-                                      'eth0': NetworkctlListState(idx=3,
-                                                                  name='eth0',
-                                                                  type='eth',
-                                                                  operational='dormant',
-                                                                  administrative='configured')}
+            wlan0 = NetworkctlListState(idx=3, name='wlan0', type='wlan',
+                                        operational='dormant',
+                                        administrative='configured')
+            self.dp.interfaces = InterfaceRegistry()
             # invalid typ
             caplog.clear()
             caplog.set_level(logging.DEBUG)
@@ -520,8 +3316,6 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
             # unknown iface idx seen
             caplog.clear()
             caplog.set_level(logging.DEBUG)
-            self.dp.iface_names_by_idx = {}
-            mock_interface_scan.return_value = {1: 'lo', 2: 'eth0', 3: 'wlan0'}
             assert (self.dp._receive_signal('org.freedesktop.'
                                             'network1.Link',
                                             '', None,
@@ -533,7 +3327,6 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
             mock_interface_scan.assert_called_with()
             # unknown iface idx even after reload
             caplog.clear()
-            mock_interface_scan.return_value = {1: 'lo', 2: 'eth0'}
             assert (self.dp._receive_signal('org.freedesktop.'
                                             'network1.Link',
                                             '', None,
@@ -544,7 +3337,7 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
             mock_interface_scan.assert_called_with()
             assert warn == 'Unknown interface index 3 seen even after reload'
             # handle_state called with right things
-            self.dp.iface_names_by_idx = {1: 'lo', 2: 'eth0', 3: 'wlan0'}
+            self.dp.interfaces = InterfaceRegistry([wlan0])
             data = dbus.Dictionary(
                 {dbus.String('OperationalState'):
                  dbus.String('routable', variant_level=1)},
@@ -558,8 +3351,22 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
             mock_handle_state.assert_called_with('wlan0',
                                                  administrative_state=None,
                                                  operational_state='routable')
-            # remove ifaces (ifaces_by_name and iface_names_by_idx pop'd)
-            self.dp.iface_names_by_idx = {1: 'lo', 2: 'eth0', 3: 'wlan0'}
+            # changes of other properties are ignored
+            mock_handle_state.reset_mock()
+            ignored = self.dp.metrics.signals_ignored['no_relevant_properties']
+            data = dbus.Dictionary(
+                {dbus.String('BitRates'): dbus.Array([1, 2])},
+                signature=dbus.Signature('sv'))
+            assert (self.dp._receive_signal('org.freedesktop.'
+                                            'network1.Link',
+                                            data, None,
+                                            '/org/freedesktop/network1/'
+                                            'link/_33')
+                    is None)
+            assert not mock_handle_state.called
+            assert (self.dp.metrics.signals_ignored['no_relevant_properties']
+                    == ignored + 1)
+            # remove ifaces
             data = dbus.Dictionary(
                 {dbus.String('AdministrativeState'):
                  dbus.String('linger', variant_level=1)},
@@ -573,18 +3380,13 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
             mock_handle_state.assert_called_with('wlan0',
                                                  administrative_state='linger',
                                                  operational_state=None)
-            _, _, warn = caplog.record_tuples[1]
-            assert warn == 'Unknown index 3 seen, reloading interface list'
-            assert 3 not in self.dp.iface_names_by_idx.keys()
-            assert 'wlan0' not in self.dp.ifaces_by_name.keys()
+            assert 3 not in self.dp.interfaces.by_idx
+            assert self.dp.interfaces.get('wlan0') is None
             # keyerror when removing iface
             caplog.clear()
-            self.dp.iface_names_by_idx = {1: 'lo', 2: 'eth0', 3: 'wlan0'}
-            data = dbus.Dictionary(
-                {dbus.String('AdministrativeState'):
-                 dbus.String('linger', variant_level=1)},
-                signature=dbus.Signature('sv'))
-            self.dp.ifaces_by_name = {}
+            self.dp.interfaces = mock.MagicMock()
+            self.dp.interfaces.by_idx = {3: wlan0}
+            self.dp.interfaces.remove.side_effect = KeyError(3)
             assert (self.dp._receive_signal('org.freedesktop.'
                                             'network1.Link',
                                             data, None,
@@ -597,6 +3399,268 @@ with patch.object(networkd_dispatcher.Dispatcher, "_interface_scan",
             _, _, err = caplog.record_tuples[1]
             assert err == 'Unable to remove interface at index 3.'
 
+        @patch.object(networkd_dispatcher.Dispatcher, 'get_link_status')
+        def test_get_script_env_snapshot(self, mock_get_link_status,
+                                         monkeypatch,
+                                         get_networkctl_status_out):
+            monkeypatch.setattr(self.dp, 'snapshots',
+                                networkd_dispatcher.SnapshotCache(60))
+            monkeypatch.setattr(networkd_dispatcher, 'get_wlan_essid',
+                                lambda x: 'whatever')
+            mock_get_link_status.return_value = get_networkctl_status_out
+            iface = NetworkctlListState(idx=2, name='wlan0', type='wlan',
+                                        operational='routable',
+                                        administrative='configured')
+            env = self.dp.get_script_env(iface)
+            assert env['IFACE'] == 'wlan0'
+            assert env['OperationalState'] == 'routable'
+            assert 'STATE' not in env
+            assert self.dp.get_script_env(iface) is env
+            # state changed: environment is rebuilt from the same status
+            env = self.dp.get_script_env(iface._replace(operational='off'))
+            assert env['OperationalState'] == 'off'
+            assert mock_get_link_status.call_count == 1
+            # status collected again once invalidated
+            self.dp.snapshots.invalidate('wlan0')
+            env = self.dp.get_script_env(iface)
+            assert mock_get_link_status.call_count == 2
+            # interfaces changed in place
+            iface = networkd_dispatcher.Interface(*iface)
+            assert self.dp.get_script_env(iface) is env
+            iface.operational = 'off'
+            assert self.dp.get_script_env(iface)['OperationalState'] == 'off'
+
+        @patch.object(networkd_dispatcher.Dispatcher, 'handle_state')
+        def test__handle_signal_snapshot(self, mock_handle_state,
+                                         monkeypatch):
+            snapshots = mock.MagicMock()
+            monkeypatch.setattr(self.dp, 'snapshots', snapshots)
+            wlan0 = NetworkctlListState(idx=3, name='wlan0', type='wlan',
+                                        operational='routable',
+                                        administrative='configured')
+            monkeypatch.setattr(self.dp, 'interfaces',
+                                InterfaceRegistry([wlan0]))
+            self.dp._handle_signal(3, {'BitRates': '(tt)'})
+            snapshots.invalidate.assert_not_called()
+            self.dp._handle_signal(3, {'IPv6AddressState': 'routable'})
+            snapshots.invalidate.assert_called_once_with('wlan0')
+            mock_handle_state.assert_not_called()
+            # operational state changes may come with new addresses
+            snapshots.reset_mock()
+            self.dp._handle_signal(3, {'OperationalState': 'degraded'})
+            snapshots.invalidate.assert_called_once_with('wlan0')
+            mock_handle_state.assert_called_once()
+            # administrative state changes alone keep the collected status
+            snapshots.reset_mock()
+            self.dp._handle_signal(3, {'AdministrativeState': 'configuring'})
+            snapshots.invalidate.assert_not_called()
+            # removed interface
+            snapshots.reset_mock()
+            self.dp._handle_signal(3, {'AdministrativeState': 'linger'})
+            snapshots.invalidate.assert_called_once_with('wlan0')
+            assert len(self.dp.interfaces) == 0
+            # removed from the state file
+            state_cache = mock.MagicMock()
+            monkeypatch.setattr(self.dp, 'state_cache', state_cache)
+            self.dp.interfaces.update([wlan0])
+            self.dp._handle_signal(3, {'AdministrativeState': 'linger'})
+            state_cache.forget.assert_called_with('wlan0')
+
+        @patch.object(glib, 'idle_add')
+        @patch.object(networkd_dispatcher.Dispatcher, 'handle_state')
+        def test__receive_signal_queued(self, mock_handle_state,
+                                        mock_idle_add, monkeypatch, caplog):
+            monkeypatch.setattr(self.dp, 'hook_runner', mock.MagicMock())
+            monkeypatch.setattr(self.dp, 'interfaces', InterfaceRegistry([
+                NetworkctlListState(3, 'wlan0', 'wlan', 'dormant',
+                                    'configured')]))
+            mock_idle_add.return_value = 7
+            data = dbus.Dictionary(
+                {dbus.String('OperationalState'):
+                 dbus.String('routable', variant_level=1),
+                 dbus.String('IPv4AddressState'):
+                 dbus.String('routable', variant_level=1),
+                 dbus.String('BitRates'):
+                 dbus.String('(tt)', variant_level=1)},
+                signature=dbus.Signature('sv'))
+            path = '/org/freedesktop/network1/link/_33'
+            self.dp._receive_signal('org.freedesktop.network1.Link', data,
+                                    None, path)
+            self.dp._receive_signal('org.freedesktop.network1.Link', {},
+                                    None, path)
+            # only queued, with a single idle callback
+            mock_handle_state.assert_not_called()
+            mock_idle_add.assert_called_once_with(self.dp._dispatch_events)
+            assert list(self.dp.events) == [(3, {'OperationalState':
+                                                 'routable',
+                                                 'IPv4AddressState':
+                                                 'routable'}),
+                                            (3, {})]
+            assert type(self.dp.events[0][1]['OperationalState']) is str
+            assert self.dp._dispatch_events() is True
+            mock_handle_state.assert_called_once_with(
+                'wlan0', administrative_state=None,
+                operational_state='routable')
+            assert self.dp._dispatch_events() is False
+            assert mock_handle_state.call_count == 1
+            assert self.dp._dispatch_source is None
+            # exceptions do not stop the dispatch of later events
+            mock_handle_state.side_effect = Exception()
+            self.dp._receive_signal('org.freedesktop.network1.Link', data,
+                                    None, path)
+            caplog.clear()
+            assert self.dp._dispatch_events() is False
+            _, _, ex = caplog.record_tuples[0]
+            assert ex == 'Error handling event for interface index 3'
+
+        @patch.object(networkd_dispatcher.Dispatcher, '_handle_signal')
+        def test__receive_signal_coalesced(self, mock_handle_signal,
+                                           monkeypatch, child_watches):
+            monkeypatch.setattr(self.dp, 'coalesce_ms', 50)
+            monkeypatch.setattr(self.dp, 'coalesced', 0)
+            path = '/org/freedesktop/network1/link/_33'
+            for state in ('carrier', 'degraded', 'routable'):
+                self.dp._receive_signal('org.freedesktop.network1.Link',
+                                        {'OperationalState': state}, None,
+                                        path)
+            self.dp._receive_signal('org.freedesktop.network1.Link',
+                                    {'AdministrativeState': 'configured'},
+                                    None, path)
+            # signals without states are not delayed
+            self.dp._receive_signal('org.freedesktop.network1.Link',
+                                    {'Carrier': True}, None, path)
+            mock_handle_signal.assert_called_once_with(3, {'Carrier': True})
+            assert self.dp.coalesced == 2
+            interval, function, data = child_watches.timeouts[1]
+            assert interval == 50
+            assert function(*data) is False
+            mock_handle_signal.assert_called_with(
+                3, {'OperationalState': 'routable',
+                    'AdministrativeState': 'configured'})
+            assert self.dp._coalescing == {}
+            # states to keep are handled immediately, with earlier updates
+            self.dp._receive_signal('org.freedesktop.network1.Link',
+                                    {'OperationalState': 'degraded'}, None,
+                                    path)
+            self.dp._receive_signal('org.freedesktop.network1.Link',
+                                    {'AdministrativeState': 'linger'}, None,
+                                    path)
+            mock_handle_signal.assert_called_with(
+                3, {'OperationalState': 'degraded',
+                    'AdministrativeState': 'linger'})
+            assert child_watches.removed == [2]
+            assert self.dp._coalescing == {}
+
+        def test_write_metrics(self, monkeypatch, tmp_path, caplog):
+            dp = Dispatcher()
+            dp.interfaces.update([NetworkctlListState(1, 'lo', 'loopback',
+                                                      'carrier', 'unmanaged')])
+            path = str(tmp_path / 'metrics.prom')
+            assert dp.write_metrics(path) is True
+            with open(path) as fh:
+                out = fh.read()
+            assert 'networkd_dispatcher_interfaces 1\n' in out
+            assert 'networkd_dispatcher_event_queue_depth 0\n' in out
+            assert not os.path.exists(path + '.tmp')
+            # errors are logged
+            caplog.clear()
+            path = str(tmp_path / 'missing' / 'metrics.prom')
+            assert dp.write_metrics(path) is True
+            _, _, err = caplog.record_tuples[0]
+            assert err.startswith('Unable to write metrics to %r' % path)
+
+        @patch.object(networkd_dispatcher.StateCache, 'load')
+        def test_state_file(self, mock_load):
+            assert Dispatcher().state_cache is None
+            dp = Dispatcher(state_file='/run/state.json')
+            assert dp.state_cache.path == '/run/state.json'
+            mock_load.assert_called_with(dp.interfaces)
+            assert not dp.state_cache.readonly
+            # dry runs do not record the states no script was run for
+            dp = Dispatcher(state_file='/run/state.json', dry_run=True)
+            assert dp.state_cache.readonly
+
+        @patch.object(networkd_dispatcher, 'ScriptIndex')
+        @patch.object(Dispatcher, 'trigger_all')
+        @patch.object(Dispatcher, '_handle_signal')
+        @patch.object(Dispatcher, '_interface_scan')
+        def test_start(self, mock_interface_scan, mock_handle_signal,
+                       mock_trigger_all, mock_script_index, caplog):
+            calls = mock.MagicMock()
+            calls.attach_mock(mock_interface_scan, 'scan')
+            calls.attach_mock(mock_trigger_all, 'trigger_all')
+            calls.attach_mock(mock_handle_signal, 'handle')
+            dp = Dispatcher(scan=False)
+            assert dp.script_index is None
+            mock_interface_scan.assert_not_called()
+            # signals are held until the interfaces are known
+            dp._receive_signal('org.freedesktop.network1.Link',
+                               {'OperationalState': 'routable',
+                                'BitRates': '(tt)'},
+                               None, '/org/freedesktop/network1/link/_33')
+            assert dp.pending_events == [(3, {'OperationalState':
+                                              'routable'})]
+            mock_handle_signal.assert_not_called()
+            caplog.clear()
+            caplog.set_level(logging.INFO)
+            assert dp.start(run_triggers=True) is False
+            assert calls.mock_calls == [
+                mock.call.scan(), mock.call.trigger_all(),
+                mock.call.handle(3, {'OperationalState': 'routable'})]
+            assert dp.script_index is mock_script_index.return_value
+            assert (dp.limits.index is dp.matches.index is
+                    dp.parallel_dirs.index is dp.batch_dirs.index is
+                    dp.script_index)
+            assert dp.pending_events is None
+            _, _, info = caplog.record_tuples[0]
+            assert info == 'Handling 1 events received during startup'
+            # startup times
+            assert 'startup_ready_seconds' not in dp.get_state_metrics()
+            dp.metrics.ready_seconds = 0.25
+            state = dp.get_state_metrics()
+            assert state['startup_ready_seconds'] == (
+                'gauge', 'Seconds from start until readiness was notified',
+                0.25)
+            assert state['startup_scanned_seconds'][2] > 0
+            # without pending events or triggers
+            mock_trigger_all.reset_mock()
+            dp = Dispatcher(scan=False, script_cache=False)
+            dp.start()
+            assert dp.script_index is None
+            mock_trigger_all.assert_not_called()
+
+        @patch.object(networkd_dispatcher, 'SpawnHelper')
+        def test_spawn_helper(self, mock_spawn_helper, caplog):
+            assert Dispatcher().spawn_helper is None
+            dp = Dispatcher(spawn_helper=True, max_workers=1)
+            assert dp.spawn_helper is mock_spawn_helper.return_value
+            assert dp.hook_runner.spawn_helper is dp.spawn_helper
+            # scripts are started directly if the helper cannot be started
+            mock_spawn_helper.side_effect = OSError(errno.EAGAIN, 'Again')
+            caplog.clear()
+            assert Dispatcher(spawn_helper=True).spawn_helper is None
+            _, _, err = caplog.record_tuples[0]
+            assert err == ('Unable to start spawn helper; starting scripts '
+                           'directly: [Errno 11] Again')
+
+        def test_get_state_metrics(self, monkeypatch):
+            dp = Dispatcher(max_workers=2, snapshot_ttl=1)
+            state = dp.get_state_metrics()
+            assert state['scripts_running'] == ('gauge', 'Scripts running', 0)
+            assert state['script_backlog'][2] == 0
+            assert state['script_index_hits_total'] == (
+                'counter', 'Lookups answered from the script index', 0)
+            assert state['snapshot_cache_misses_total'][2] == 0
+            assert 'essid_cache_hits_total' not in state
+            monkeypatch.setattr(networkd_dispatcher, 'WLAN_ESSIDS',
+                                mock.Mock(hits=3, misses=1))
+            state = dp.get_state_metrics()
+            assert state['essid_cache_hits_total'][2] == 3
+            assert state['essid_cache_misses_total'][2] == 1
+            dp = Dispatcher(script_cache=False)
+            assert 'script_index_hits_total' not in dp.get_state_metrics()
+            assert 'script_backlog' not in dp.get_state_metrics()
+
 
 @patch('networkd_dispatcher.main')
 def test___main__(mock_main, monkeypatch):
@@ -612,6 +3676,103 @@ def test_parse_args(monkeypatch):
     # trigger-all
     parser = networkd_dispatcher.parse_args(['-T'])
     assert parser.run_startup_triggers
+    # backend
+    parser = networkd_dispatcher.parse_args([])
+    assert parser.backend == 'networkctl'
+    parser = networkd_dispatcher.parse_args(['--backend', 'dbus'])
+    assert parser.backend == 'dbus'
+    # netlink addresses
+    parser = networkd_dispatcher.parse_args(['--netlink-addresses'])
+    assert parser.netlink_addresses
+    # script cache
+    assert networkd_dispatcher.parse_args([]).script_cache
+    parser = networkd_dispatcher.parse_args(['--no-script-cache'])
+    assert not parser.script_cache
+    # concurrent scripts
+    parser = networkd_dispatcher.parse_args(['-j', '4', '--script-timeout',
+                                             '30'])
+    assert parser.max_workers == 4
+    assert parser.script_timeout == 30
+    # coalescing
+    parser = networkd_dispatcher.parse_args([])
+    assert parser.coalesce_ms == 0
+    assert parser.coalesce_keep == 'off,linger'
+    parser = networkd_dispatcher.parse_args(['--coalesce-ms', '200',
+                                             '--coalesce-keep', 'off'])
+    assert parser.coalesce_ms == 200
+    assert parser.coalesce_keep == 'off'
+    # snapshots
+    assert networkd_dispatcher.parse_args([]).snapshot_ttl == 0
+    parser = networkd_dispatcher.parse_args(['--snapshot-ttl', '2.5'])
+    assert parser.snapshot_ttl == 2.5
+    # batching
+    assert networkd_dispatcher.parse_args([]).batch_ms == 0
+    parser = networkd_dispatcher.parse_args(['--batch-ms', '200'])
+    assert parser.batch_ms == 200
+    # early readiness
+    assert not networkd_dispatcher.parse_args([]).early_ready
+    assert networkd_dispatcher.parse_args(['--early-ready']).early_ready
+    # spawn helper
+    assert not networkd_dispatcher.parse_args([]).spawn_helper
+    assert networkd_dispatcher.parse_args(['--spawn-helper']).spawn_helper
+    # state file
+    parser = networkd_dispatcher.parse_args([])
+    assert parser.state_file == '/run/networkd-dispatcher/state.json'
+    parser = networkd_dispatcher.parse_args(['--state-file', ''])
+    assert parser.state_file == ''
+    # metrics
+    assert networkd_dispatcher.parse_args([]).metrics_file is None
+    parser = networkd_dispatcher.parse_args(['--metrics-file', '/tmp/m.prom',
+                                             '--metrics-interval', '60'])
+    assert parser.metrics_file == '/tmp/m.prom'
+    assert parser.metrics_interval == 60
+    # recording and replay
+    parser = networkd_dispatcher.parse_args([])
+    assert parser.record is None
+    assert parser.replay is None
+    assert parser.replay_speed == 0
+    assert not parser.dry_run
+    parser = networkd_dispatcher.parse_args(['--record', '/tmp/a.jsonl',
+                                             '--replay', '/tmp/b.jsonl',
+                                             '--replay-speed', '10',
+                                             '--dry-run'])
+    assert parser.record == '/tmp/a.jsonl'
+    assert parser.replay == '/tmp/b.jsonl'
+    assert parser.replay_speed == 10
+    assert parser.dry_run
+    # script environment
+    parser = networkd_dispatcher.parse_args([])
+    assert parser.env_keep is None
+    assert parser.env_strip == ''
+    parser = networkd_dispatcher.parse_args(['--env-keep', 'PATH,LANG',
+                                             '--env-strip', 'LANG'])
+    assert parser.env_keep == 'PATH,LANG'
+    assert parser.env_strip == 'LANG'
+    # plugins
+    parser = networkd_dispatcher.parse_args([])
+    assert parser.plugin_dir is None
+    assert parser.plugin_budget == 1.0
+    parser = networkd_dispatcher.parse_args(['--plugin-dir', '/etc/plugins',
+                                             '--plugin-budget', '0.1'])
+    assert parser.plugin_dir == '/etc/plugins'
+    assert parser.plugin_budget == 0.1
+    # event socket
+    assert networkd_dispatcher.parse_args([]).event_socket is None
+    parser = networkd_dispatcher.parse_args(['--event-socket',
+                                             '/run/events.sock'])
+    assert parser.event_socket == '/run/events.sock'
+    # reconciliation
+    assert networkd_dispatcher.parse_args([]).reconcile_interval == 0
+    parser = networkd_dispatcher.parse_args(['--reconcile-interval', '300'])
+    assert parser.reconcile_interval == 300
+    # logging
+    parser = networkd_dispatcher.parse_args([])
+    assert parser.log_format == 'text'
+    assert parser.log_rate_limit == 60
+    parser = networkd_dispatcher.parse_args(['--log-format', 'journal',
+                                             '--log-rate-limit', '0'])
+    assert parser.log_format == 'journal'
+    assert parser.log_rate_limit == 0
     # verbosity
     parser = networkd_dispatcher.parse_args(['-vvvv'])
     assert parser.verbose == 4
@@ -622,12 +3783,12 @@ def test_parse_args(monkeypatch):
 
 @patch.object(networkd_dispatcher, 'sd_notify')
 @patch.object(glib, 'MainLoop')
-@patch.object(logging, 'basicConfig')
+@patch.object(networkd_dispatcher, 'setup_logging')
 @patch.object(Dispatcher, 'trigger_all')
 @patch.object(Dispatcher, 'register')
 @patch.object(Dispatcher, '_interface_scan')
 def test_main(mock_iface_scan, mock_register, mock_trigger_all,
-              mock_logging_basicconfig, mock_glib_mainloop, mock_sd_notify,
+              mock_setup_logging, mock_glib_mainloop, mock_sd_notify,
               monkeypatch, caplog):
     # networkctl is None
     monkeypatch.setattr(sys, 'argv', ['networkd-dispatcher'])
@@ -638,31 +3799,91 @@ def test_main(mock_iface_scan, mock_register, mock_trigger_all,
         mock_sd_notify.assert_called_with(ERRNO=errno.ENOENT)
         _, _, crit = caplog.record_tuples[1]
         assert crit == 'Unable to find networkctl command; cannot continue'
+    # networkctl is not needed with the dbus backend
+    monkeypatch.setattr(sys, 'argv', ['networkd-dispatcher', '-b', 'dbus'])
+    networkd_dispatcher.main()
+    mock_sd_notify.assert_called_with(READY=1)
     monkeypatch.setattr(networkd_dispatcher, 'NETWORKCTL',
                         '/usr/bin/networkctl')
     # test verbosity config
     monkeypatch.setattr(sys, 'argv', ['networkd-dispatcher', '-v'])
     networkd_dispatcher.main()
-    mock_logging_basicconfig.assert_called_with(level=logging.INFO,
-                                                format=LOG_FORMAT)
+    mock_setup_logging.assert_called_with(logging.INFO, 'text', 60)
     monkeypatch.setattr(sys, 'argv', ['networkd-dispatcher', '-vv'])
     networkd_dispatcher.main()
-    mock_logging_basicconfig.assert_called_with(level=logging.DEBUG,
-                                                format=LOG_FORMAT)
+    mock_setup_logging.assert_called_with(logging.DEBUG, 'text', 60)
     monkeypatch.setattr(sys, 'argv', ['networkd-dispatcher', '-qqv'])
     networkd_dispatcher.main()
-    mock_logging_basicconfig.assert_called_with(level=logging.ERROR,
-                                                format=LOG_FORMAT)
+    mock_setup_logging.assert_called_with(logging.ERROR, 'text', 60)
     monkeypatch.setattr(sys, 'argv', ['networkd-dispatcher', '-vvqqqq'])
     networkd_dispatcher.main()
-    mock_logging_basicconfig.assert_called_with(level=logging.CRITICAL,
-                                                format=LOG_FORMAT)
+    mock_setup_logging.assert_called_with(logging.CRITICAL, 'text', 60)
     monkeypatch.setattr(sys, 'argv', ['networkd-dispatcher', '-vvqq'])
     networkd_dispatcher.main()
-    mock_logging_basicconfig.assert_called_with(level=logging.WARNING,
-                                                format=LOG_FORMAT)
+    mock_setup_logging.assert_called_with(logging.WARNING, 'text', 60)
     # run_startup_triggers
     monkeypatch.setattr(sys, 'argv', ['networkd-dispatcher', '-T'])
     networkd_dispatcher.main()
     mock_sd_notify.assert_called_with(READY=1)
     mock_trigger_all.assert_called_with()
+    # early readiness
+    mock_trigger_all.reset_mock()
+    monkeypatch.setattr(sys, 'argv', ['networkd-dispatcher', '-T',
+                                      '--early-ready'])
+    with patch.object(glib, 'idle_add') as mock_idle_add, \
+            patch.object(Dispatcher, 'start') as mock_start:
+        networkd_dispatcher.main()
+        mock_start.assert_not_called()
+        mock_idle_add.assert_called_with(mock_start, True)
+    mock_trigger_all.assert_not_called()
+    mock_sd_notify.assert_called_with(READY=1)
+    # replay
+    monkeypatch.setattr(sys, 'argv', ['networkd-dispatcher', '--replay',
+                                      '/tmp/events.jsonl', '--dry-run'])
+    mock_sd_notify.reset_mock()
+    with patch.object(networkd_dispatcher, 'replay') as mock_replay:
+        networkd_dispatcher.main()
+        args, options = mock_replay.call_args[0]
+        assert args.replay == '/tmp/events.jsonl'
+        assert options['dry_run']
+    mock_sd_notify.assert_not_called()
+    # metrics file
+    monkeypatch.setattr(sys, 'argv', ['networkd-dispatcher', '--metrics-file',
+                                      '/run/metrics.prom'])
+    with patch.object(glib, 'timeout_add_seconds') as mock_timeout:
+        networkd_dispatcher.main()
+        interval, function, path = mock_timeout.call_args[0]
+        assert interval == 15
+        assert function.__name__ == 'write_metrics'
+        assert path == '/run/metrics.prom'
+
+
+@patch.object(Dispatcher, 'handle_state')
+def test_replay(mock_handle_state, tmp_path, monkeypatch, caplog):
+    FakeMainLoop(monkeypatch)
+    path = str(tmp_path / 'events.jsonl')
+    metrics_path = str(tmp_path / 'metrics.prom')
+    # unreadable event logs
+    args = networkd_dispatcher.parse_args(['--replay', path])
+    with pytest.raises(SystemExit):
+        networkd_dispatcher.replay(args, {})
+    _, _, crit = caplog.record_tuples[-1]
+    assert crit.startswith('Unable to read event log %r: ' % path)
+    # replayed, with the metrics written afterwards
+    write_event_log(path, [
+        {'kind': 'list', 'links': [[3, 'eth0', 'ether', 'routable',
+                                    'configured']], 't': 0},
+        {'kind': 'signal', 'typ': 'org.freedesktop.network1.Link',
+         'path': '/org/freedesktop/network1/link/_33',
+         'data': {'OperationalState': 'degraded'}, 't': 0}])
+    args = networkd_dispatcher.parse_args(['--replay', path,
+                                           '--metrics-file', metrics_path])
+    networkd_dispatcher.replay(args, {'script_cache': False})
+    mock_handle_state.assert_called_with('eth0', administrative_state=None,
+                                         operational_state='degraded')
+    with open(metrics_path) as fh:
+        assert 'networkd_dispatcher_signals_received_total 1\n' in fh.read()
+    networkd_dispatcher.replay(
+        networkd_dispatcher.parse_args(['--replay', path]),
+        {'script_cache': False})
+    assert mock_handle_state.call_count == 2